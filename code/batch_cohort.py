@@ -0,0 +1,290 @@
+# python script to gather the preprocessed long data of all participants (<subjectid>_merged_pupil_long_AFTER.csv,
+# written by batch_preprocess_part2.py) into one cohort dataset, instead of concatenating every long csv in memory
+# (load_data(type='long') in utils.R, the long_pupil_task cell of Preprocess_cleanup_github.ipynb)
+
+# the dataset is a folder with one partition per participant (subject=<subjectid>/, one .npy file per column as in
+# the pypil cache, see pypil.write_columns) and a dataset_info.json listing, for each partition, its number of rows,
+# its columns, the blocks and events it contains and the hash of the csv it was built from. Only the partitions
+# whose csv changed are (re)written. CohortDataset memory-maps the partitions, so selecting participants, blocks or
+# events only reads the partitions and rows that are needed.
+
+# build_epoch_store stacks the event-locked epochs of all participants (see pypil.epoch_data) into one
+# memory-mapped float32 array of participants x trials x time (epochs.npy, NaN padded), with a sidecar
+# epoch_index.csv giving the subject, block, trial and task condition of every (participant, trial) slot.
+# EpochStore reads it back, so grand averages, bootstraps and plots only read the slices they need.
+
+# usage: python batch_cohort.py --dataset ../../Data_All_Cleaned/long_pupil_dataset
+#        python batch_cohort.py --epochs ../../Data_All_Cleaned/epochs_stimulus --lock-event stimulus_pre_with_fixation_onset
+
+import argparse
+import json
+import os
+import shutil
+import warnings
+from glob import glob
+
+import numpy as np
+import pandas as pd
+
+import batch_manifest
+import batch_preprocess
+import pypil
+
+# string columns of the long data, stored as categories
+category_cols = ['ID', 'event', 'identifier']
+
+
+def build_dataset(part_dirs, dataset_dir, overwrite=False):
+    '''
+    add the long data of every participant in part_dirs to the dataset in dataset_dir (one partition each),
+    skipping participants whose partition was built from the same csv. Returns the CohortDataset.
+    '''
+    os.makedirs(dataset_dir, exist_ok=True)
+    dataset = CohortDataset(dataset_dir)
+    for data_dir in part_dirs:
+        try:
+            long_file = glob(os.path.join(data_dir, '*_merged_pupil_long_AFTER.csv'))[0]
+        except IndexError:
+            print('{} has no long data'.format(data_dir))
+            continue
+        subjectid = os.path.basename(long_file).replace('_merged_pupil_long_AFTER.csv', '')
+        source = batch_manifest.file_hash(long_file)
+        if not overwrite and dataset.partitions.get(subjectid, {}).get('source') == source and \
+                os.path.exists(dataset.partition_dir(subjectid)):
+            print('{} is up to date'.format(subjectid))
+            continue
+
+        long_data = pd.read_csv(long_file, index_col=0, dtype={col: 'category' for col in category_cols})
+        directory = dataset.partition_dir(subjectid)
+        # start from an empty folder, a new csv may have fewer columns
+        shutil.rmtree(directory, ignore_errors=True)
+        dataset.partitions[subjectid] = {
+            'source': source, 'n_rows': len(long_data),
+            'columns': pypil.write_columns(directory, long_data),
+            'blocks': sorted(long_data['block'].dropna().astype(int).unique().tolist()) if 'block' in long_data else [],
+            'events': sorted(long_data['event'].dropna().astype(str).unique().tolist()) if 'event' in long_data else []}
+        # saved after every participant, so an interrupted build keeps the partitions written so far
+        dataset.save()
+        print('{} added ({} rows)'.format(subjectid, len(long_data)))
+    return dataset
+
+
+class CohortDataset(object):
+    '''
+    the cohort dataset in dataset_dir (see build_dataset), read lazily from its memory-mapped partitions
+    '''
+
+    def __init__(self, dataset_dir):
+        self.dataset_dir = dataset_dir
+        self.path = os.path.join(dataset_dir, 'dataset_info.json')
+        try:
+            with open(self.path, 'r') as f:
+                self.partitions = json.load(f)['partitions']
+        except (OSError, ValueError):
+            self.partitions = {}
+
+    def save(self):
+        # write to a temporary file first so a crash never leaves a truncated dataset_info.json behind
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'partitions': self.partitions}, f)
+        os.replace(self.path + '.tmp', self.path)
+
+    def partition_dir(self, subjectid):
+        return os.path.join(self.dataset_dir, 'subject={}'.format(subjectid))
+
+    @property
+    def subjects(self):
+        return sorted(self.partitions)
+
+    @property
+    def columns(self):
+        '''
+        all columns of the dataset, in the order they first appear in the partitions
+        '''
+        columns = {}
+        for subjectid in self.subjects:
+            columns.update(dict.fromkeys(col['name'] for col in self.partitions[subjectid]['columns']))
+        return list(columns)
+
+    def __len__(self):
+        return sum(x['n_rows'] for x in self.partitions.values())
+
+    def read(self, subjects=None, blocks=None, events=None, columns=None):
+        '''
+        return the rows of the given subjects, blocks and events (all if None) as one pd.DataFrame with the given
+        columns (all if None). Partitions without any of the blocks/events are skipped from dataset_info.json,
+        within a partition only the block and event columns are read to find the rows.
+        '''
+        frames = []
+        for subjectid in (self.subjects if subjects is None else subjects):
+            info = self.partitions[subjectid]
+            if (blocks is not None and not set(blocks) & set(info['blocks'])) or \
+                    (events is not None and not set(events) & set(info['events'])):
+                continue
+            directory = self.partition_dir(subjectid)
+
+            rows = None
+            if blocks is not None or events is not None:
+                keys = pypil.read_columns(directory, info['columns'], names=['block', 'event'])
+                mask = np.ones(info['n_rows'], dtype=bool)
+                if blocks is not None:
+                    mask &= keys['block'].isin(blocks).to_numpy()
+                if events is not None:
+                    mask &= keys['event'].isin(events).to_numpy()
+                rows = np.flatnonzero(mask)
+                if not len(rows):
+                    continue
+            frames.append(pypil.read_columns(directory, info['columns'], names=columns, rows=rows))
+
+        if not frames:
+            return pd.DataFrame(columns=self.columns if columns is None else columns)
+        data = pd.concat(frames, ignore_index=True)
+        # partitions have their own categories, which pd.concat turns into object columns
+        for col in category_cols:
+            if col in data.columns:
+                data[col] = data[col].astype('category')
+        return data
+
+
+def build_epoch_store(part_dirs, store_dir, lock_event='stimulus_pre_with_fixation_onset', window=[-1000, 3000],
+                      y_col='remove_baseline_smoothed_interp_pupil_corrected', task_cols=['Condition'], overwrite=False):
+    '''
+    cut the epochs of every participant in part_dirs from its long data (see pypil.epoch_data) and store them
+    in store_dir as one participants x trials x time array plus its index (task_cols, e.g. the condition, are
+    taken from the first row data). Skipped if the store was built with the same data and arguments.
+    Returns the EpochStore.
+    '''
+    sources = {}
+    for data_dir in part_dirs:
+        try:
+            current_file = pypil.find_recording(data_dir)
+        except IndexError:
+            continue
+        pupil_data = pypil.pypil(current_file)
+        files = [os.path.join(pupil_data.data_dir, '{}_{}.csv'.format(pupil_data.subjectid, x))
+                 for x in ['merged_pupil_long_AFTER', 'merged_pupil_first_row_AFTER']]
+        if not all(os.path.exists(x) for x in files):
+            print('{} has no long data'.format(pupil_data.subjectid))
+            continue
+        sources[pupil_data.subjectid] = (pupil_data, files)
+
+    key = pypil.hash_settings(lock_event, window, y_col, task_cols,
+                              {x: [batch_manifest.file_hash(f) for f in files] for x, (_, files) in sources.items()})
+    store = EpochStore(store_dir)
+    if not overwrite and store.info.get('key') == key:
+        print('epoch store is up to date')
+        return store
+
+    epochs, index = [], []
+    for subject_idx, subjectid in enumerate(sorted(sources)):
+        pupil_data, (long_file, first_row_file) = sources[subjectid]
+        pupil_data.merged_data = pupil_data._compact(pd.read_csv(long_file, index_col=0))
+        subject_epochs, times, trials = pupil_data.epoch_data(lock_event, window, y_col)
+        first_row = pd.read_csv(first_row_file, index_col=0)
+        if 'trial_key' not in first_row.columns:
+            # first row files written before the trial key was added
+            first_row['trial_key'] = (first_row['block'].astype('Int32') * pupil_data.trial_key_base + \
+                first_row['trial'].astype('Int32')).fillna(-1).astype(np.int32)
+        # one row per trial, so the merge keeps the rows of trials in the order of the epochs
+        first_row = first_row.drop_duplicates('trial_key')
+        trials = trials.merge(first_row[['trial_key'] + [x for x in task_cols if x in first_row.columns]],
+                              on='trial_key', how='left')
+        assert len(trials) == subject_epochs.shape[0]
+        trials.insert(0, 'subject', subjectid)
+        trials.insert(1, 'subject_idx', subject_idx)
+        trials.insert(2, 'trial_idx', np.arange(len(trials)))
+        epochs.append(subject_epochs)
+        index.append(trials)
+        print('{}: {} epochs'.format(subjectid, len(trials)))
+    if not epochs:
+        raise Exception('There is no long data to cut epochs from.')
+
+    os.makedirs(store_dir, exist_ok=True)
+    n_trials = max(len(x) for x in epochs)
+    data = np.lib.format.open_memmap(os.path.join(store_dir, 'epochs.npy'), mode='w+', dtype=np.float32,
+                                     shape=(len(epochs), n_trials, len(times)))
+    data[:] = np.nan
+    for subject_idx, subject_epochs in enumerate(epochs):
+        data[subject_idx, :len(subject_epochs)] = subject_epochs
+    data.flush()
+    del data
+    np.save(os.path.join(store_dir, 'times.npy'), times)
+    pd.concat(index, ignore_index=True).to_csv(os.path.join(store_dir, 'epoch_index.csv'), index=False)
+    # the info file goes last, so an interrupted build is not taken as up to date
+    with open(os.path.join(store_dir, 'store_info.json'), 'w') as f:
+        json.dump({'key': key, 'lock_event': lock_event, 'window': list(window), 'y_col': y_col,
+                   'subjects': sorted(sources)}, f)
+    return EpochStore(store_dir)
+
+
+class EpochStore(object):
+    '''
+    the epoch store in store_dir (see build_epoch_store): .epochs is the memory-mapped participants x trials x time
+    array, .times the time of each timepoint relative to the lock event and .index the subject, block, trial and
+    task columns of every epoch (subject_idx and trial_idx are its position in .epochs)
+    '''
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        try:
+            with open(os.path.join(store_dir, 'store_info.json'), 'r') as f:
+                self.info = json.load(f)
+        except (OSError, ValueError):
+            self.info = {}
+            return
+        self.epochs = np.load(os.path.join(store_dir, 'epochs.npy'), mmap_mode='r')
+        self.times = np.load(os.path.join(store_dir, 'times.npy'))
+        self.index = pd.read_csv(os.path.join(store_dir, 'epoch_index.csv'))
+
+    def select(self, subjects=None, **conditions):
+        '''
+        rows of self.index of the given subjects (all if None) whose columns have the given values,
+        e.g. store.select(Condition='gain') or store.select(block=[1, 2])
+        '''
+        mask = np.ones(len(self.index), dtype=bool)
+        if subjects is not None:
+            mask &= self.index['subject'].isin(subjects).to_numpy()
+        for col, values in conditions.items():
+            mask &= self.index[col].isin(values if isinstance(values, (list, tuple, set)) else [values]).to_numpy()
+        return self.index[mask]
+
+    def get(self, subjects=None, **conditions):
+        '''
+        the (n_epochs, n_timepoints) epochs selected as in select, with their index rows
+        (only these slices are read from disk)
+        '''
+        index = self.select(subjects, **conditions)
+        return self.epochs[index['subject_idx'].to_numpy(), index['trial_idx'].to_numpy()], index
+
+    def subject_means(self, subjects=None, **conditions):
+        '''
+        average time course of the selected epochs of each participant: a (n_subjects, n_timepoints) array and the
+        subjects, e.g. for a grand average (np.nanmean(means, axis=0)) or a bootstrap over participants
+        '''
+        epochs, index = self.get(subjects, **conditions)
+        codes, subjects = pd.factorize(index['subject'])
+        means = np.full((len(subjects), len(self.times)), np.nan, dtype=np.float32)
+        with warnings.catch_warnings():
+            # all-NaN timepoints of a participant stay NaN
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            for idx in range(len(subjects)):
+                means[idx] = np.nanmean(epochs[codes == idx], axis=0)
+        return means, np.asarray(subjects)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Gather the long data (or the epochs) of all participants.')
+    parser.add_argument('--dataset', default=None)
+    parser.add_argument('--epochs', default=None)
+    parser.add_argument('--lock-event', default='stimulus_pre_with_fixation_onset')
+    parser.add_argument('--window', nargs=2, type=float, default=[-1000, 3000])
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args()
+
+    part_dirs = batch_preprocess.part_dirs[:batch_preprocess.idx_max + 1]
+    if args.epochs is None or args.dataset is not None:
+        dataset = build_dataset(part_dirs, args.dataset or '../../Data_All_Cleaned/long_pupil_dataset', args.overwrite)
+        print('{} participants, {} rows'.format(len(dataset.subjects), len(dataset)))
+    if args.epochs is not None:
+        store = build_epoch_store(part_dirs, args.epochs, args.lock_event, args.window, overwrite=args.overwrite)
+        print('epochs of shape {}'.format(store.epochs.shape))
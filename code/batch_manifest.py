@@ -0,0 +1,84 @@
+# helper to keep track of the batch preprocessing of each participant (used by batch_preprocess.py,
+# batch_preprocess_part2.py and batch_parallel.py)
+
+# every participant gets a <subjectid>_manifest.json in its data folder recording, for each stage
+# (prepare / filter / process / baseline / part2), its status, its key (a hash of the stage's inputs and
+# settings, chained with the key of the stage it depends on), when it started, how long it took and the
+# traceback if it failed. A stage only runs again when it did not finish, its key changed or its output
+# files are gone, so an interrupted or crashed cohort run resumes where it stopped.
+
+import datetime
+import hashlib
+import json
+import os
+import time
+import traceback
+
+import pypil
+
+
+def file_hash(filename):
+    '''
+    sha1 hex digest of the content of filename
+    '''
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class SubjectManifest(object):
+    '''
+    stage bookkeeping of a single participant, stored in <data_dir>/<subjectid>_manifest.json
+    '''
+
+    def __init__(self, data_dir, subjectid):
+        self.path = os.path.join(data_dir, '{}_manifest.json'.format(subjectid))
+        try:
+            with open(self.path, 'r') as f:
+                self.stages = json.load(f)
+        except (OSError, ValueError):
+            self.stages = {}
+
+    def save(self):
+        # write to a temporary file first so a crash never leaves a truncated manifest behind
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.stages, f, indent=2)
+        os.replace(self.path + '.tmp', self.path)
+
+    def key(self, *items):
+        '''
+        key of a stage from its inputs and settings (see pypil.hash_settings)
+        '''
+        return pypil.hash_settings(*items)
+
+    def is_current(self, stage, key, outputs=()):
+        '''
+        whether stage finished with the same key and all of its output files still exist
+        '''
+        entry = self.stages.get(stage, {})
+        return entry.get('status') == 'done' and entry.get('key') == key and \
+            all(os.path.exists(x) for x in outputs)
+
+    def run(self, stage, key, func, *args, info=None, **kwargs):
+        '''
+        run func(*args, **kwargs) as stage, recording its status, timing and traceback (the exception is
+        raised again after it was recorded). info is a dict of extra fields to store with the stage.
+        '''
+        entry = {'status': 'running', 'key': key, 'started': datetime.datetime.now().isoformat(timespec='seconds'),
+                 'time': None, 'error': None}
+        entry.update(info or {})
+        self.stages[stage] = entry
+        self.save()
+
+        start = time.time()
+        try:
+            output = func(*args, **kwargs)
+        except Exception:
+            entry.update(status='failed', time=time.time() - start, error=traceback.format_exc())
+            self.save()
+            raise
+        entry.update(status='done', time=time.time() - start)
+        self.save()
+        return output
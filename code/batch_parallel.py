@@ -0,0 +1,88 @@
+# python script to run the batch preprocessing (batch_preprocess.py and/or batch_preprocess_part2.py)
+# for all participants in parallel
+
+# every participant is independent, so each one is sent to its own worker process of a process pool
+# (a fresh process per participant, so a failing or leaking job cannot affect the others). Results and
+# failures (with their traceback) are printed as soon as each participant finishes.
+
+# usage: python batch_parallel.py --stages part1 part2 --workers 8
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+
+import batch_preprocess
+import batch_preprocess_part2
+
+
+def run_subject(data_dir, stages=('part1', 'part2'), overwrite=False, baseline_flag=True):
+    '''
+    run the requested stages for one participant and return a small summary dict
+    (data_dir, stages done, elapsed seconds and the traceback if a stage failed)
+    '''
+    result = {'data_dir': data_dir, 'stages_done': [], 'error': None}
+    start = time.time()
+    try:
+        if 'part1' in stages:
+            # the participants already keep all cores busy, one smoothing thread per worker process
+            batch_preprocess.preprocess_subject(data_dir, overwrite, baseline_flag, smoothing_workers=1)
+            result['stages_done'].append('part1')
+        if 'part2' in stages:
+            batch_preprocess_part2.preprocess_part2_subject(data_dir, batch_preprocess_part2.task_dirs, overwrite)
+            result['stages_done'].append('part2')
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['time'] = time.time() - start
+    return result
+
+
+def run_batch(part_dirs, stages=('part1', 'part2'), workers=None, overwrite=False, baseline_flag=True):
+    '''
+    fan the participants in part_dirs out over a pool of workers (os.cpu_count() by default)
+    and yield the summary of each participant as soon as it is done
+    '''
+    if sys.version_info < (3, 11):
+        # ProcessPoolExecutor only takes max_tasks_per_child from Python 3.11 on
+        with multiprocessing.get_context('spawn').Pool(processes=workers, maxtasksperchild=1) as pool:
+            for result in pool.imap_unordered(partial(run_subject, stages=stages, overwrite=overwrite,
+                                                      baseline_flag=baseline_flag), part_dirs):
+                yield result
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, max_tasks_per_child=1) as pool:
+        futures = {pool.submit(run_subject, data_dir, stages, overwrite, baseline_flag): data_dir
+                   for data_dir in part_dirs}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception:
+                # the worker process itself died (e.g. out of memory)
+                yield {'data_dir': futures[future], 'stages_done': [], 'error': traceback.format_exc(), 'time': None}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Preprocess all participants in parallel.')
+    parser.add_argument('--stages', nargs='+', choices=['part1', 'part2'], default=['part1', 'part2'])
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--overwrite', action='store_true')
+    parser.add_argument('--no-baseline', dest='baseline_flag', action='store_false')
+    args = parser.parse_args()
+
+    part_dirs = batch_preprocess.part_dirs[:batch_preprocess.idx_max + 1]
+    start = time.time()
+    failed = []
+    for idx, result in enumerate(run_batch(part_dirs, args.stages, args.workers, args.overwrite, args.baseline_flag)):
+        if result['error']:
+            failed.append(result['data_dir'])
+            print('[{}/{}] FAILED {}\n{}'.format(idx + 1, len(part_dirs), result['data_dir'], result['error']))
+        else:
+            print('[{}/{}] done {} ({}) in {:.1f}s'.format(idx + 1, len(part_dirs), result['data_dir'],
+                                                        ', '.join(result['stages_done']), result['time']))
+    print('{} participants processed in {:.1f}s, {} failed'.format(len(part_dirs), time.time() - start, len(failed)))
+    for data_dir in failed:
+        print('    ', data_dir)
@@ -17,6 +17,9 @@
 
 
 import pypil
+import batch_manifest
+import os
+import traceback
 import pandas as pd
 from glob import glob
 from itertools import compress
@@ -30,27 +33,74 @@ overwrite = False
 idx = 0
 baseline_flag = True
 
-for data_dir in part_dirs:
-    if idx <= idx_max:
-        try:
-            current_file = glob(data_dir + '*asc')[0]
-            print(idx, 'Index of the current preprocessing job:')
-            print('    ', current_file)
-            pupil_data = pypil.pypil(current_file)
-            pupil_data.prepare_phase(overwrite)
-            pupil_data.filter_phase(overwrite)
-            pupil_data.process_valid_samples(overwrite)
-            # read in task df using subjectid stored in pypil object
-            # Haoxue Aug: DO NOT do it here - merging is not necessary yet
-            # task_df = pd.read_csv(list(compress(task_dirs, \
-            #     [pupil_data.subjectid in x for x in task_dirs]))[0])
-            # pupil_data.choice_msgpupil_merge(task_df)
-            if baseline_flag:
-                pupil_data.merged_data = pupil_data.baseline_pupil_data.copy(deep=True)
-                pupil_data.filter_phase(overwrite, baseline_flag)
-                pupil_data.process_valid_samples(overwrite, baseline_flag)
-            idx = idx + 1
-            print('\n')
-        except Exception:
-            continue
 
+def preprocess_subject(data_dir, overwrite=False, baseline_flag=True, smoothing_workers=None):
+    '''
+    run prepare, filter and process valid samples phases for the .asc (or .edf) file in data_dir
+    (and for its baseline if baseline_flag). Stages that the participant's manifest (see batch_manifest.py)
+    records as done with the same inputs and settings are skipped. smoothing_workers overrides
+    interp_settings['smoothing_workers'] (e.g. 1 when several participants run in parallel). Returns the pypil object.
+    '''
+    current_file = pypil.find_recording(data_dir)
+    print('    ', current_file)
+    pupil_data = pypil.pypil(current_file)
+    pupil_data.default_filter_settings()
+    pupil_data.default_interp_settings()
+    if smoothing_workers is not None:
+        pupil_data.interp_settings['smoothing_workers'] = smoothing_workers
+    manifest = batch_manifest.SubjectManifest(pupil_data.data_dir, pupil_data.subjectid)
+
+    # chained keys: a change upstream changes the key of every stage below it
+    source = pupil_data.source_signature(manifest.stages.get('prepare', {}).get('source'))
+    prepare_key = manifest.key(source['source_hash'], pupil_data.prepare_key())
+    filter_key = manifest.key(prepare_key, pupil_data.stage_settings('filter'))
+    process_key = manifest.key(filter_key, pupil_data.stage_settings('process'))
+    baseline_key = manifest.key(prepare_key, pupil_data.stage_settings('filter'), pupil_data.stage_settings('process'))
+
+    redo_prepare = overwrite or not manifest.is_current('prepare', prepare_key,
+                                                        [os.path.join(pupil_data.cache_dir, 'cache_info.json')])
+    # the filter output only lives in memory, so it is redone whenever process is
+    redo_process = overwrite or not (manifest.is_current('filter', filter_key) and manifest.is_current(
+        'process', process_key, [os.path.join(pupil_data.data_dir, '{}_merged_pupil.csv'.format(pupil_data.subjectid))]))
+    redo_baseline = baseline_flag and (overwrite or not manifest.is_current('baseline', baseline_key, [
+        os.path.join(pupil_data.data_dir, '{}_merged_pupil_baseline.csv'.format(pupil_data.subjectid))]))
+    if not (redo_prepare or redo_process or redo_baseline):
+        print('{} is up to date'.format(pupil_data.subjectid))
+        return pupil_data
+
+    if redo_prepare:
+        manifest.run('prepare', prepare_key, pupil_data.prepare_phase, True, info={'source': source})
+    else:
+        # loads the prepared data from the binary cache
+        pupil_data.prepare_phase(False)
+
+    if redo_process:
+        # unchanged stages are loaded from pypil's stage cache
+        manifest.run('filter', filter_key, pupil_data.filter_phase, overwrite)
+        manifest.run('process', process_key, pupil_data.process_valid_samples, overwrite)
+    # read in task df using subjectid stored in pypil object
+    # Haoxue Aug: DO NOT do it here - merging is not necessary yet
+    # task_df = pd.read_csv(list(compress(task_dirs, \
+    #     [pupil_data.subjectid in x for x in task_dirs]))[0])
+    # pupil_data.choice_msgpupil_merge(task_df)
+    if redo_baseline:
+        def baseline_phases():
+            pupil_data.merged_data = pupil_data.baseline_pupil_data.copy(deep=True)
+            pupil_data.filter_phase(overwrite, baseline_flag)
+            pupil_data.process_valid_samples(overwrite, baseline_flag)
+        manifest.run('baseline', baseline_key, baseline_phases)
+    return pupil_data
+
+
+if __name__ == '__main__':
+    for data_dir in part_dirs:
+        if idx <= idx_max:
+            try:
+                print(idx, 'Index of the current preprocessing job:')
+                preprocess_subject(data_dir, overwrite, baseline_flag)
+                idx = idx + 1
+                print('\n')
+            except Exception:
+                # the traceback is also kept in the participant's manifest
+                traceback.print_exc()
+                continue
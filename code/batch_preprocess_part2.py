@@ -12,12 +12,15 @@
 # 5. percent_miss: calculate percent of missing data within each trial
 
 # 6. avg_within_timewindow: a versatile function used to calculate avg over a specified timewindow
+#    (avg_within_timewindows does several windows in one pass)
 
 # 7. baseline_correct: correct trial pupil data using its corresponding baseline
 
 # written by Haoxue Fan (haoxue_fan@g.harvard.edu) 
 
 import pypil
+import batch_manifest
+import os
 import pandas as pd
 from glob import glob
 from itertools import compress
@@ -35,60 +38,76 @@ baseline_flag = True
 
 # part_dirs = ['../../Real_Subject_Data/29XXOO_(06-13-2022)/']
 
-for data_dir in part_dirs:
-    print(data_dir)
-    try: 
-        current_file = glob(data_dir + '*asc')[0]
-    except Exception:
-        continue
-    if idx <= idx_max:
-        try:
-            current_file = glob(data_dir + '*asc')[0]
-            print(idx, 'Index of the current preprocessing job:')
-            print('    ', current_file)
-            pupil_data = pypil.pypil(current_file)
-            # find task df
-            task_df = list(compress(task_dirs, \
-                [pupil_data.subjectid in x for x in task_dirs]))[0]
-            pupil_data.read_merged_and_task(task_df, overwrite)
-            
-            pupil_data.drop_redundant_column()
-            pupil_data.remove_irrelevant_events()
-
-            pupil_data.add_first_row_pupil()
-            pupil_data.add_timestamp()
-
-            pupil_data.percent_miss()
-            
-            pupil_data.avg_within_timewindow(\
-                timestamp_col='timestamp_locked_at_stimulus_pre_with_fixation_onset',\
-                y_col='smoothed_interp_pupil_corrected',\
-                timestamp_range=[-1000, 0],\
-                new_x_col='trial_baseline')
-            pupil_data.baseline_correct()
-            pupil_data.write_merged_and_task(overwrite)
-            # pupil_data.avg_within_timewindow(\
-            #     timestamp_col='timestamp_locked_at_stimulus_pre_with_fixation_onset',\
-            #     y_col='remove_baseline_smoothed_interp_pupil_corrected',\
-            #     timestamp_range=[500, 2500],\
-            #     new_x_col='eval_middle_2000')
-
-            # pupil_data.avg_within_timewindow(\
-            #     timestamp_col='timestamp_locked_at_stimulus_pre_with_fixation_onset',\
-            #     y_col='remove_baseline_smoothed_interp_pupil_corrected',\
-            #     timestamp_range=[1000, 2500],\
-            #     new_x_col='eval_middle_1500')
-
-            # pupil_data.avg_within_timewindow(\
-            #     timestamp_col='timestamp_locked_at_stimulus_pre_with_fixation_onset',\
-            #     y_col='remove_baseline_smoothed_interp_pupil_corrected',\
-            #     timestamp_range=[1000, 3000],\
-            #     new_x_col='eval_late_2000')
-
-
-            idx = idx + 1
-            print('\n')
+
+def preprocess_part2_subject(data_dir, task_dirs=task_dirs, overwrite=False):
+    '''
+    run the part 2 steps for the .asc (or .edf) file in data_dir (its preprocessed files need to exist)
+    and write the long, first row and task files. Skipped if the participant's manifest (see batch_manifest.py)
+    records part 2 as done with the same processed data and task file. Returns the pypil object.
+    '''
+    current_file = pypil.find_recording(data_dir)
+    print('    ', current_file)
+    pupil_data = pypil.pypil(current_file)
+    # find task df
+    task_df = list(compress(task_dirs, \
+        [pupil_data.subjectid in x for x in task_dirs]))[0]
+
+    manifest = batch_manifest.SubjectManifest(pupil_data.data_dir, pupil_data.subjectid)
+    part2_key = manifest.key(manifest.stages.get('process', {}).get('key'), batch_manifest.file_hash(task_df))
+    outputs = [os.path.join(pupil_data.data_dir, '{}_{}.csv'.format(pupil_data.subjectid, x)) for x in
+               ['merged_pupil_first_row_AFTER', 'merged_pupil_long_AFTER', 'task_AFTER']]
+    if not overwrite and manifest.is_current('part2', part2_key, outputs):
+        print('{} is up to date'.format(pupil_data.subjectid))
+        return pupil_data
+    # outputs written from other processed data or another task file are stale and have to be replaced
+    stale = any(os.path.exists(x) for x in outputs) and manifest.stages.get('part2', {}).get('key') != part2_key
+    manifest.run('part2', part2_key, part2_steps, pupil_data, task_df, overwrite or stale)
+    return pupil_data
+
+
+def part2_steps(pupil_data, task_df, overwrite=False):
+    '''
+    the part 2 steps listed at the top of this script, writing their output files (existing ones only if overwrite)
+    '''
+    pupil_data.read_merged_and_task(task_df, overwrite)
+    
+    pupil_data.drop_redundant_column()
+    pupil_data.remove_irrelevant_events()
+
+    pupil_data.add_first_row_pupil()
+    pupil_data.add_timestamp()
+
+    pupil_data.percent_miss()
+    
+    pupil_data.avg_within_timewindow(\
+        timestamp_col='timestamp_locked_at_stimulus_pre_with_fixation_onset',\
+        y_col='smoothed_interp_pupil_corrected',\
+        timestamp_range=[-1000, 0],\
+        new_x_col='trial_baseline')
+    pupil_data.baseline_correct()
+    pupil_data.write_merged_and_task(overwrite)
+    # later windows can all be averaged at once (one pass over the long data, one merge):
+    # pupil_data.avg_within_timewindows([\
+    #     ('stimulus_pre_with_fixation_onset', [500, 2500], 'remove_baseline_smoothed_interp_pupil_corrected', 'eval_middle_2000'),\
+    #     ('stimulus_pre_with_fixation_onset', [1000, 2500], 'remove_baseline_smoothed_interp_pupil_corrected', 'eval_middle_1500'),\
+    #     ('stimulus_pre_with_fixation_onset', [1000, 3000], 'remove_baseline_smoothed_interp_pupil_corrected', 'eval_late_2000')])
+
+
+if __name__ == '__main__':
+    for data_dir in part_dirs:
+        print(data_dir)
+        try: 
+            current_file = pypil.find_recording(data_dir)
         except Exception:
             continue
+        if idx <= idx_max:
+            try:
+                print(idx, 'Index of the current preprocessing job:')
+                preprocess_part2_subject(data_dir, task_dirs, overwrite)
+                idx = idx + 1
+                print('\n')
+            except Exception:
+                # the traceback is also kept in the participant's manifest
+                traceback.print_exc()
+                continue
         
-
@@ -4,7 +4,487 @@ import re
 import numpy as np
 import pandas as pd
 from io import StringIO
+from fractions import Fraction
+import hashlib
+import json
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+
+
+class _SampleSink(object):
+    """
+    Collects EyeLink sample lines (time, x, y, pupil, dots) and decodes them chunk by chunk into
+    preallocated NumPy arrays, so neither the raw text lines nor a python-engine read_csv are needed.
+    Missing values ('.') become NaN and the dots column (e.g. '...', 'C..') is kept as strings.
+    The sample lines of binocular recordings hold the x, y and pupil of the left and then of the right eye
+    (binocular_columns).
+    """
+
+    columns = ['time', 'x', 'y', 'pupil', 'dots']
+    binocular_columns = ['time', 'x_left', 'y_left', 'pupil_left', 'x_right', 'y_right', 'pupil_right', 'dots']
+
+    def __init__(self, columns=None, capacity=2**16, chunk_size=2**14):
+        if columns is not None:
+            self.columns = columns
+        self.values = np.empty((capacity, len(self.columns) - 1))
+        self.dots = np.empty(capacity, dtype=object)
+        self.n = 0
+        self.chunk_size = chunk_size
+        self.buffer = []
+
+    def __len__(self):
+        return self.n + len(self.buffer)
+
+    def append(self, line):
+        self.buffer.append(line)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        decode the buffered lines into the arrays, growing them if needed
+        """
+        if not self.buffer:
+            return
+        n_cols = len(self.columns)
+        fields = ''.join(self.buffer).split()
+        # the total alone can hide a line with a missing field and another with an extra one
+        if len(fields) == n_cols * len(self.buffer) and all(len(x.split()) == n_cols for x in self.buffer):
+            fields = np.array(fields, dtype=object).reshape(-1, n_cols)
+        else:
+            # ragged lines (e.g. a missing dots column), pad/cut them one by one
+            fields = np.array([(x.split() + ['.'] * n_cols)[:n_cols] for x in self.buffer], dtype=object)
+        n_new = fields.shape[0]
+        if self.n + n_new > self.values.shape[0]:
+            capacity = max(2 * self.values.shape[0], self.n + n_new)
+            self.values = np.resize(self.values, (capacity, self.values.shape[1]))
+            self.dots = np.resize(self.dots, capacity)
+
+        numeric = fields[:, :-1]
+        numeric[numeric == '.'] = 'nan'
+        self.values[self.n:self.n + n_new] = numeric.astype(float)
+        self.dots[self.n:self.n + n_new] = fields[:, -1]
+        self.n += n_new
+        self.buffer = []
+
+    def extend(self, values, dots):
+        """
+        add samples that are already decoded (an (n, len(self.columns) - 1) array of time, x, y and pupil, and their dots)
+        """
+        self.flush()
+        n_new = len(values)
+        if self.n + n_new > self.values.shape[0]:
+            capacity = max(2 * self.values.shape[0], self.n + n_new)
+            self.values = np.resize(self.values, (capacity, self.values.shape[1]))
+            self.dots = np.resize(self.dots, capacity)
+        self.values[self.n:self.n + n_new] = values
+        self.dots[self.n:self.n + n_new] = dots
+        self.n += n_new
+
+    def truncate(self, n):
+        """
+        keep only the first n samples
+        """
+        self.flush()
+        self.n = min(self.n, n)
+
+    def to_frame(self):
+        """
+        return the decoded samples as a pd.DataFrame (time is kept as integer when possible, x, y and pupil
+        are float32). Binocular samples also get the x, y and pupil averaged over the eyes that have them
+        (pupil 0 when neither has), so the rest of the pipeline finds the columns it expects.
+        """
+        self.flush()
+        data = dict(zip(self.columns[1:-1], self.values[:self.n, 1:].T.astype(np.float32)))
+        time = self.values[:self.n, 0]
+        data['time'] = time.astype(np.int64) if np.array_equal(time, np.round(time)) else time.copy()
+        data['dots'] = self.dots[:self.n].copy()
+        columns = self.columns
+        if 'pupil_left' in data:
+            for col in ['x', 'y', 'pupil']:
+                eyes = np.stack([data[col + '_left'], data[col + '_right']])
+                has_value = (eyes > 0) if col == 'pupil' else ~np.isnan(eyes)
+                with np.errstate(invalid='ignore'):
+                    data[col] = (np.where(has_value, eyes, 0).sum(axis=0) / has_value.sum(axis=0)).astype(np.float32)
+            data['pupil'][np.isnan(data['pupil'])] = 0
+            columns = ['time', 'x', 'y', 'pupil'] + self.columns[1:]
+        return pd.DataFrame(data, columns=columns)
+
+
+def hash_settings(*items):
+    """
+    Return the sha1 hex digest of items (settings dicts, lists, hashes of upstream inputs...), so that a stage
+    can tell whether it needs to run again. NumPy arrays/scalars and pandas objects are hashed by value.
+    """
+    def to_json(x):
+        if isinstance(x, np.ndarray):
+            return x.tolist()
+        if isinstance(x, np.generic):
+            return x.item()
+        if isinstance(x, (pd.Series, pd.DataFrame)):
+            return int(pd.util.hash_pandas_object(x).sum())
+        raise TypeError('Cannot hash object of type {}'.format(type(x)))
+
+    return hashlib.sha1(json.dumps(items, sort_keys=True, default=to_json).encode()).hexdigest()
+
+
+def write_columns(directory, df):
+    """
+    write the columns of df to directory (one .npy file per column) and return their description for
+    read_columns. String columns are stored as category codes plus a unicode array of the categories.
+    """
+    os.makedirs(directory, exist_ok=True)
+    columns = []
+    for idx, col in enumerate(df.columns):
+        path = os.path.join(directory, '{}'.format(idx))
+        if df[col].dtype == object or isinstance(df[col].dtype, pd.CategoricalDtype):
+            values = pd.Categorical(df[col])
+            np.save(path + '_codes.npy', values.codes)
+            np.save(path + '_categories.npy', np.array(values.categories.astype(str), dtype=str))
+            columns.append({'name': col, 'kind': 'str', 'categorical': isinstance(df[col].dtype, pd.CategoricalDtype)})
+        else:
+            # nullable integers are stored as float with NaN for the missing values
+            is_nullable = isinstance(df[col].dtype, pd.api.extensions.ExtensionDtype)
+            np.save(path + '.npy', df[col].to_numpy(dtype=float, na_value=np.nan) if is_nullable else df[col].to_numpy())
+            columns.append({'name': col, 'kind': 'num', 'dtype': str(df[col].dtype) if is_nullable else None})
+    return columns
+
+
+def read_columns(directory, columns, names=None, rows=None):
+    """
+    load the columns written by write_columns into a pd.DataFrame (numeric columns are memory-mapped copy-on-write).
+    names restricts the columns that are loaded, rows (positions or a boolean mask) the rows; as the files are
+    memory-mapped only the requested rows are read.
+    """
+    data = {}
+    for idx, col in enumerate(columns):
+        if names is not None and col['name'] not in names:
+            continue
+        path = os.path.join(directory, '{}'.format(idx))
+        if col['kind'] == 'str':
+            codes = np.load(path + '_codes.npy', mmap_mode='r')
+            values = pd.Categorical.from_codes(codes if rows is None else codes[rows],
+                                               categories=np.load(path + '_categories.npy').astype(object))
+            data[col['name']] = values if col['categorical'] else values.astype(object)
+        else:
+            values = np.load(path + '.npy', mmap_mode='c')
+            if rows is not None:
+                values = values[rows]
+            data[col['name']] = pd.array(values, dtype=col['dtype']) if col.get('dtype') else values
+    return pd.DataFrame(data, columns=list(data))
+
+
+def find_recording(data_dir):
+    """
+    the recording of a participant in data_dir: its .asc file, or its EyeLink .edf file if it was not converted
+    (see pypil.read_edf). Raises an IndexError if there is neither.
+    """
+    return (glob(os.path.join(data_dir, '*asc')) + glob(os.path.join(data_dir, '*.edf')) + glob(os.path.join(data_dir, '*.EDF')))[0]
+
+
+
+# Filter engine of the filter phase (see pypil.filter_phase). It works on plain NumPy arrays: the time stamps,
+# the pupil diameters and the validity mask of all samples go in, the final validity mask and the filter
+# diagnostics come out. The steps follow the pandas implementation they replace sample for sample.
+# Inside the engine the pupil diameters and validity mask are (n_eyes, n_samples) arrays, so both eyes of a
+# binocular recording are filtered in the same pass on their shared time stamps (each eye with its own thresholds).
+
+def _row_medians(values, n):
+    """
+    median of the first n[i] values of every row i of the 2-d array values, whose other values are inf, from a
+    single (in place) partition of all the rows
+    """
+    lo, hi = np.maximum((n - 1) // 2, 0), n // 2
+    values.partition(np.unique(np.r_[lo, hi]), axis=1)
+    rows = np.arange(len(values))
+    median = (values[rows, lo] + values[rows, hi]) / 2
+    median[n == 0] = np.nan
+    return median
+
+
+def _mad_threshold(values, mad_multiplier):
+    """
+    median absolute deviation of each row of values (one per eye, ignoring NaN) and the thresholds
+    median + mad_multiplier * mad
+    """
+    # as np.nanmedian along axis 1, but all the eyes share a partition (NaN are moved to the end as inf)
+    n = np.count_nonzero(~np.isnan(values), axis=1)
+    values = np.where(np.isnan(values), np.inf, values)
+    median = _row_medians(values, n)
+    # the order of the values does not matter for their median, so the partitioned rows are used as they are
+    mad = _row_medians(np.abs(values - median[:, None]), n)
+    return median, mad, median + mad_multiplier * mad
+
+
+def _valid_samples(time, is_valid):
+    """
+    time stamps of the valid samples of is_valid (eye by eye, as pupil[is_valid]) and where the valid samples of
+    every eye start among them
+    """
+    eye_starts = np.r_[0, np.cumsum(np.count_nonzero(is_valid, axis=1))[:-1]]
+    return np.broadcast_to(time, is_valid.shape)[is_valid], eye_starts
+
+
+def _remove_loners(time, candidate, is_valid, filter_settings):
+    """
+    return is_valid & candidate without the samples of candidate that form a 'sample island': a cluster
+    separated from other candidate samples (of the same eye) by more than island_filter_seperation_ms and
+    narrower than island_filter_island_width_ms
+    """
+    # These were labeled backwards in Kret & Sjak-Shie (2018). Correct logic but mis-informative naming scheme.
+    min_sep = filter_settings['island_filter_seperation_ms']
+    max_island_width = filter_settings['island_filter_island_width_ms']
+
+    # label the islands by run length: a new island starts wherever the gap to the previous candidate sample
+    # is larger than min_sep (or at the first sample of an eye), and its width is the time between its first
+    # and last sample
+    out = np.zeros_like(is_valid)
+    valid_time, eye_starts = _valid_samples(time, candidate)
+    if not len(valid_time):
+        return out
+    new_island = np.empty(len(valid_time), dtype=bool)
+    new_island[0] = True
+    np.greater(np.diff(valid_time), min_sep, out=new_island[1:])
+    new_island[eye_starts[eye_starts < len(valid_time)]] = True
+    starts = np.flatnonzero(new_island)
+    ends = np.r_[starts[1:], len(valid_time)]
+    widths = valid_time[ends - 1] - valid_time[starts]
+
+    out[candidate] = is_valid[candidate] & np.repeat(widths >= max_island_width, ends - starts)
+    return out
+
+
+def _expand_gaps(time, is_valid, filter_settings):
+    """
+    reject the samples on the edges of gaps in the valid samples that are between gap_min_width and gap_max_width long
+    """
+    min_gap = filter_settings['gap_min_width']
+    max_gap = filter_settings['gap_max_width']
+    back_pad = filter_settings['gap_padding_backward']
+    fwd_pad = filter_settings['gap_padding_forward']
+    if not (min_gap and max_gap and back_pad > 0 and fwd_pad > 0):
+        return is_valid
+
+    # Blinks produce gaps in the data, the edges of these gaps may contain additional artifacts
+    valid_time, eye_starts = _valid_samples(time, is_valid)
+    gaps = np.diff(valid_time.astype(float))
+    needs_padding = (gaps > min_gap) & (gaps < max_gap)
+    needs_padding[eye_starts[(eye_starts > 0) & (eye_starts < len(valid_time))] - 1] = False
+    # the sample right before (gap start) and right after (gap end) each gap
+    near_gap = np.r_[needs_padding, False] | np.r_[False, needs_padding]
+
+    out = is_valid.copy()
+    out[is_valid] = ~near_gap
+    return out
+
+
+def _mad_speed_filter(time, pupil, is_valid, filter_settings):
+    """
+    reject the samples with outlying dilation speeds (blinks and other artifacts), then islands and gap edges.
+    Returns the new validity mask and the speed filter diagnostics.
+    """
+    max_gap_distance = filter_settings['dialation_speed_filter_max_gap_ms']
+    # the valid samples of all eyes, one eye after the other
+    valid_time, eye_starts = _valid_samples(time, is_valid)
+    valid_pupil = pupil[is_valid]
+
+    # Calculate dilation speed (displacement / time), not across gaps longer than max_gap_distance
+    # (nor from one eye to the other)
+    time_diff = np.r_[np.nan, np.diff(valid_time)]
+    time_diff[eye_starts[eye_starts < len(valid_time)]] = np.nan
+    dilation_speeds = np.r_[np.nan, np.diff(valid_pupil)] / time_diff
+    dilation_speeds[time_diff > max_gap_distance] = np.nan
+
+    # largest absolute change in speed towards the previous or next sample (NaN only if both are NaN)
+    speed_diff = np.diff(dilation_speeds)
+    max_dilation_speeds = np.fmax(np.abs(np.r_[np.nan, speed_diff]), np.abs(np.r_[speed_diff, np.nan]))
+
+    # Calculate the threshold of every eye and mark the outliers
+    speeds = np.full(pupil.shape, np.nan)
+    speeds[is_valid] = max_dilation_speeds
+    med_d, mad, thresh = _mad_threshold(speeds, filter_settings['dialation_speed_filter_MAD_multiplier'])
+    speed_valid = speeds <= thresh[:, None]
+
+    # remove any remaining islands and the samples surrounding gaps of a certain size
+    speed_valid = _remove_loners(time, speed_valid, speed_valid, filter_settings)
+    speed_valid = _expand_gaps(time, speed_valid, filter_settings)
+    return speed_valid, {'max_dilation_speeds': speeds, 'is_valid': speed_valid, 'mad': mad, 'med_d': med_d,
+                         'thresh': thresh}
+
+
+def _settle_samples(b, a, tol=1e-16):
+    """
+    number of samples after which the response of the filter (b, a) to a change in its input has decayed below
+    tol (relative), applied forwards and backwards as in signal.filtfilt
+    """
+    pole = np.abs(np.roots(a)).max() if len(a) > 1 else 0
+    if pole == 0:
+        return len(b)
+    return 2 * int(np.ceil(np.log(tol) / np.log(pole))) + len(b)
+
+
+def _changed_windows(changed, anchors, margin, n_samples):
+    """
+    merged [start, stop) windows of the samples whose trendline can change when the samples in changed switch
+    validity: everything between the valid samples (anchors) around each changed sample, plus margin on either side
+    """
+    pos = np.searchsorted(anchors, changed)
+    starts = np.where(pos > 0, anchors[np.maximum(pos - 1, 0)], 0) - margin
+    stops = np.where(pos < len(anchors), anchors[np.minimum(pos, len(anchors) - 1)], n_samples - 1) + margin + 1
+    starts, stops = np.maximum(starts, 0), np.minimum(stops, n_samples)
+
+    # changed is sorted, so the windows are too; merge the overlapping ones
+    if not len(changed):
+        return starts, stops
+    new_window = np.r_[True, starts[1:] > np.maximum.accumulate(stops)[:-1]]
+    return starts[new_window], np.maximum.reduceat(stops, np.flatnonzero(new_window))
+
+
+def _mad_deviation_filter(time, pupil, is_valid, filter_settings):
+    """
+    reject the samples that deviate from a smooth trendline through the valid samples, in up to
+    residuals_filter_passes passes (stopping early once a pass changes nothing for any eye). Returns the new
+    validity mask and, if filter_settings['keep_filter_data'], the residuals and trendlines (float32) and validity
+    masks of every pass.
+
+    After the first pass the trendline of each eye is only recomputed around the samples whose validity changed,
+    over windows wide enough for the low pass filter to settle (see _settle_samples), so it matches
+    a full recomputation to within rounding.
+    """
+    n_passes = filter_settings['residuals_filter_passes']
+    smooth_filtB = filter_settings['residuals_filter_lowpassB']
+    smooth_filtA = filter_settings['residuals_filter_lowpassA']
+    margin = _settle_samples(smooth_filtB, smooth_filtA)
+
+    assert (is_valid.sum(axis=1) > 3).all(  # Arbitrary got from Kret & Sjak-Shie (2018)
+            ), "There needs to be greater than 3 valid time points to interpolate."
+
+    passes = []
+    is_valid_init = is_valid
+    smooth_valid = None  # validity mask the current trendline was computed from
+    for pass_ind in range(n_passes):
+        is_valid_start = is_valid
+
+        # Generate a smooth signal using linear interpolation, and nearest neighbor extrapolation,
+        # from the currently valid samples, and low pass filter it
+        if smooth_valid is not None:
+            # windows around the samples whose validity changed, each one margin wider on either side
+            windows = []
+            for eye_valid, eye_smooth_valid in zip(is_valid, smooth_valid):
+                changed = np.flatnonzero(eye_valid != eye_smooth_valid)
+                starts, stops = _changed_windows(changed, np.flatnonzero(eye_valid & eye_smooth_valid), margin, len(time))
+                ext_starts, ext_stops = np.maximum(starts - margin, 0), np.minimum(stops + margin, len(time))
+                windows.append((changed, starts, stops, ext_starts, ext_stops - ext_starts))
+        if smooth_valid is None or any(lengths.sum() > len(time) // 2 for *_, lengths in windows):
+            # the eyes share the time stamps, so their trendlines are low pass filtered in one go
+            interp_pupil = np.array([np.interp(time, time[eye_valid], eye_pupil[eye_valid])
+                                     for eye_pupil, eye_valid in zip(pupil, is_valid)])
+            smooth_pupil = signal.filtfilt(smooth_filtB, smooth_filtA, interp_pupil)
+            resid = np.abs(pupil - smooth_pupil)
+        else:
+            for eye, (changed, starts, stops, ext_starts, lengths) in enumerate(windows):
+                if not len(changed):
+                    continue
+                # all windows are filtered in one go, back to back: the edges of the windows and the jumps between
+                # them settle before the part of each window that is kept
+                offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+                ext_idx = np.repeat(ext_starts, lengths) + np.arange(lengths.sum()) - offsets
+                # interpolate from the valid samples around each window sample only (the same ones np.interp would pick)
+                valid_idx = np.flatnonzero(is_valid[eye])
+                pos = np.searchsorted(valid_idx, ext_idx)
+                near_idx = np.unique(valid_idx[np.r_[np.maximum(pos - 1, 0), np.minimum(pos, len(valid_idx) - 1)]])
+                smooth_ext = signal.filtfilt(smooth_filtB, smooth_filtA,
+                                             np.interp(time[ext_idx], time[near_idx], pupil[eye, near_idx]))
+                keep = (ext_idx >= np.repeat(starts, lengths)) & (ext_idx < np.repeat(stops, lengths))
+                smooth_pupil[eye, ext_idx[keep]] = smooth_ext[keep]
+                resid[eye, ext_idx[keep]] = np.abs(pupil[eye, ext_idx[keep]] - smooth_ext[keep])
+        smooth_valid = is_valid
+
+        # Remove outliers and isolated samples
+        # (the pandas implementation used the dilation speed multiplier here too; kept for identical results)
+        _, _, thresh = _mad_threshold(resid, filter_settings['dialation_speed_filter_MAD_multiplier'])
+        is_valid = _remove_loners(time, (resid <= thresh[:, None]) & is_valid_init, is_valid, filter_settings)
+        if filter_settings['keep_filter_data']:
+            passes.append((resid.astype(np.float32), smooth_pupil.astype(np.float32), is_valid))
+
+        # If this pass did not have any effect, neither will any of the others
+        if pass_ind and np.array_equal(is_valid_start, is_valid):
+            print('pass_ind:', pass_ind)
+            passes.extend(passes[-1:] * (n_passes - pass_ind - 1))
+            break
+    return is_valid, passes
+
+
+def filter_samples(time, pupil, is_valid, filter_settings):
+    """
+    Run the three steps of the filter phase of Kret & Sjak-Shie (2018) on NumPy arrays of the time stamps [ms]
+    and pupil diameters of all samples, starting from the validity mask is_valid:
+
+    Step 1: Remove out-of-bound samples (and islands)
+    Step 2: Blink detection via speed filtering
+    Step 3: Outliers rejection via residual analysis
+
+    pupil and is_valid are either 1-d (a single pupil) or (n_samples, n_eyes) arrays, e.g. the left and right
+    pupil of a binocular recording, which are filtered in the same pass (each eye with its own thresholds).
+
+    Returns the final validity mask, the speed filter diagnostics and the (residual, trendline, validity mask)
+    of every deviation filter pass (see filter_settings['keep_filter_data']), all shaped like pupil. The max
+    dilation speeds are NaN where the speed filter started from an invalid sample; for a single pupil they
+    are given for the other samples only, as (indices, speeds).
+    """
+    time = np.asarray(time)
+    pupil = np.asarray(pupil)
+    single_pupil = pupil.ndim == 1
+    # eye by eye, each eye contiguous in memory
+    pupil = np.ascontiguousarray(pupil.reshape(len(pupil), -1).T)
+    min_val = filter_settings['pupil_diameter_min']
+    max_val = filter_settings['pupil_diameter_max']
+    assert (min_val < max_val
+            ), "The maximum pupil diameter must be larger than the minimum"
+
+    # Step 1: Remove Out-of-Bounds Samples:
+    is_valid = np.asarray(is_valid, dtype=bool).reshape(pupil.shape[::-1]).T
+    is_valid = np.ascontiguousarray(is_valid) & (pupil >= min_val) & (pupil <= max_val)
+    is_valid = _remove_loners(time, is_valid, is_valid, filter_settings)
+
+    # Step 2: Blink Detection via Speed Filter:
+    speed_input = is_valid
+    is_valid, speed_data = _mad_speed_filter(time, pupil, is_valid, filter_settings)
+
+    # Step 3: Outlier Rejection via Residuals Analysis:
+    is_valid, passes = _mad_deviation_filter(time, pupil, is_valid, filter_settings)
+
+    # back to the shape of pupil (for a single pupil, the max dilation speeds of the samples the speed filter
+    # started from come with their indices)
+    if single_pupil:
+        idx = np.flatnonzero(speed_input[0])
+        speed_data = {'max_dilation_speeds': (idx, speed_data['max_dilation_speeds'][0, idx]),
+                      'is_valid': speed_data['is_valid'][0], 'mad': speed_data['mad'][0],
+                      'med_d': speed_data['med_d'][0], 'thresh': speed_data['thresh'][0]}
+        return is_valid[0], speed_data, [tuple(x[0] for x in pass_data) for pass_data in passes]
+    speed_data['max_dilation_speeds'] = speed_data['max_dilation_speeds'].T
+    speed_data['is_valid'] = speed_data['is_valid'].T
+    return is_valid.T, speed_data, [tuple(x.T for x in pass_data) for pass_data in passes]
+
+
+def mean_pupil(pupil, is_valid):
+    """
+    Combine the left and right pupil (the two columns of pupil, with their validity masks in is_valid) into a
+    single pupil diameter as in Kret & Sjak-Shie (2018): the mean of both eyes where both are valid and, where only
+    one is valid, that eye shifted by half the mean difference between the eyes (over the samples where both are
+    valid), so the combined signal does not jump when one of the eyes drops out. Returns the combined pupil (NaN
+    where neither eye is valid) and its validity mask.
+    """
+    pupil = np.where(is_valid, pupil, np.nan).astype(float)
+    both_valid = is_valid.all(axis=1)
+    mean_diff = np.mean(pupil[both_valid, 0] - pupil[both_valid, 1]) if both_valid.any() else 0.
+    combined = pupil.mean(axis=1)
+    left_only = is_valid[:, 0] & ~is_valid[:, 1]
+    right_only = is_valid[:, 1] & ~is_valid[:, 0]
+    combined[left_only] = pupil[left_only, 0] - mean_diff / 2
+    combined[right_only] = pupil[right_only, 1] + mean_diff / 2
+    return combined, is_valid.any(axis=1)
 
 
 class pypil(object):
@@ -31,8 +511,19 @@ class pypil(object):
         self.filename = filename
         self.subjectid = re.search('(.+?)_', os.path.split(self.filename)[1]).group(1)
         self.sf = 250 # Sampling frequency (aka Hz) that you want to be sampled at (if downsampling)
+        self.down_sample_method = 'pick' # 'pick' every eyelinkrate/sf-th sample or anti-aliased 'polyphase' resampling
+        self.keep_raw_data = False # keep full-rate copies (*_raw attributes) after downsampling
+        self.write_raw_csv = True # write the intermediate merged and downsampled csv files of the prepare phase
+        self.block_margin_ms = 2000 # samples of the neighbouring blocks each block is filtered with (see process_in_blocks)
         self.include_pupil = False  # Don't include until you have met all conditions
         self.data_dir = os.path.split(self.filename)[0] 
+        self.cache_dir = os.path.join(self.data_dir, '{}_cache'.format(self.subjectid))
+        self.cache_tables = ['message_data', 'pupil_data', 'merged_data', 'baseline_pupil_data']
+        # columns of merged_data produced by the filter and process phases (kept per settings, see write_stage)
+        self.stage_columns = {'filter': ['inter_pupil', 'is_valid', 'is_valid_left', 'is_valid_right', 'valid_time'],
+                              'process': ['smoothed_interp_pupil', 'smoothed_interp_pupil_corrected', 'inter_pupil_corrected']}
+        # other tables produced by these phases
+        self.stage_tables = {'filter': [], 'process': ['upsampled_data']}
         self.event_list = ['fixation_onset','stimulus_pre_with_fixation_onset','stimulus_pre_green_fixation_onset',\
             'early_key_press','key_press','reward_pre_red_fixation_onset',\
                 'block_start','before_drift_check','start_drift_check','blank_screen'] 
@@ -46,48 +537,304 @@ class pypil(object):
         self.end_blocks_str = 'BLOCKID 16'
         self.redundant_col = ['index','dots', 'time_step', 'inter_pupil', 'valid_time', \
             'smoothed_interp_pupil']
-        self.redundant_col_first_row = ['x','y','pupil','event','is_valid','smoothed_interp_pupil_corrected','inter_pupil_corrected']
+        self.redundant_col_first_row = ['x','y','pupil','event','is_valid','smoothed_interp_pupil_corrected','inter_pupil_corrected',
+            'x_left', 'y_left', 'pupil_left', 'x_right', 'y_right', 'pupil_right', 'is_valid_left', 'is_valid_right'] # the last ones only exist for binocular recordings
+        # memory-lean dtypes of the per-sample data (see _compact)
+        self.compact_dtypes = {'ID': 'category', 'event': 'category', 'block': 'Int16', 'trial': 'Int16',
+                               'x': np.float32, 'y': np.float32, 'pupil': np.float32,
+                               'x_left': np.float32, 'y_left': np.float32, 'pupil_left': np.float32,
+                               'x_right': np.float32, 'y_right': np.float32, 'pupil_right': np.float32}
+        # trial_key = block * trial_key_base + trial (-1 outside of trials)
+        self.trial_key_base = 1000
+        # filter/interp settings that do not change the output of a stage, left out of its key (see stage_settings)
+        self.unkeyed_settings = ['keep_filter_data', 'smoothing_workers']
             
 
     def __eq__(self, other) : 
             return (self.__dict__ == other.__dict__).all()
 
+    def _sample_columns(self):
+        """
+        columns of the sample lines of the ASC file (see _SampleSink): the binocular ones if the SAMPLES line
+        before the first sample lists both the LEFT and the RIGHT eye
+        """
+        with open(self.filename, 'r') as f:
+            for line in f:
+                if line.startswith('SAMPLES'):
+                    fields = line.split()
+                    return _SampleSink.binocular_columns if 'LEFT' in fields and 'RIGHT' in fields else _SampleSink.columns
+                if line[:1].isdigit():
+                    break
+        return _SampleSink.columns
+
     def read_contents(self):
         """
-        read in all lines in the ASC file
+        stream through the ASC file once, classifying every line (sample / MSG / event / header)
+        and routing it to the baseline and task sinks consumed by organize_baseline and organize_contents.
+        The baseline sinks cover every self.start_baseline_str to self.end_baseline_str section, without the
+        samples between two sections (or those of the whole task after the last one), the task sinks the first
+        self.start_blocks_str line to the last self.end_blocks_str line. EDF files are read directly by read_edf
         """
+        if os.path.splitext(self.filename)[1].lower() == '.edf':
+            return self.read_edf()
+
+        bad_regex = re.compile('|'.join(re.escape(x) for x in self.bad_strings))
+        columns = self._sample_columns()
+        baseline_lines = {'samples': _SampleSink(columns), 'badstrings': []}
+        task_lines = {'samples': _SampleSink(columns), 'messages': [], 'badstrings': []}
+        # number of lines in each sink up to (and including) the last end marker seen so far
+        baseline_marks = dict.fromkeys(baseline_lines, 0)
+        task_marks = dict.fromkeys(task_lines, 0)
+        in_baseline = False
+        in_task = False
+        self.contain_baseline = 0
+
         with open(self.filename, 'r') as f:
-            self.content = f.readlines()
-            # detect whether the eyelink rate was stored in the first 200 lines (an arbitrary number)
-            rate_line = [x for x in self.content[:200] if 'RECCFG CR ' in x] 
-            baseline_line = [x for x in self.content if 'baseline_onset' in x]
-            if not rate_line:
-                rate_line = [x for x in self.content if 'RECCFG CR ' in x]
-            if rate_line:
-                self.eyelinkrate = int(re.search(" (\d{3,4}) ", rate_line[0]).group())
-            if not  baseline_line:
-                self.contain_baseline = 0
-            if baseline_line:
+            for line in f:
+                # samples are by far the most common lines and start with the timestamp
+                if line[:1].isdigit():
+                    if in_baseline:
+                        baseline_lines['samples'].append(line)
+                    if in_task:
+                        task_lines['samples'].append(line)
+                    continue
+
+                if not hasattr(self, 'eyelinkrate') and 'RECCFG CR ' in line:
+                    self.eyelinkrate = int(re.search(" (\d{3,4}) ", line).group())
+                if not in_baseline and self.start_baseline_str in line:
+                    in_baseline = True
+                    self.contain_baseline = 1
+                if not in_task and self.start_blocks_str in line:
+                    in_task = True
+                if not (in_baseline or in_task):
+                    continue
+
+                is_bad = bad_regex.search(line) is not None
+                if in_baseline:
+                    # baseline messages themselves are not kept
+                    if is_bad:
+                        baseline_lines['badstrings'].append(line)
+                    if self.end_baseline_str in line:
+                        baseline_marks = {k: len(v) for k, v in baseline_lines.items()}
+                        in_baseline = False
+                if in_task:
+                    if is_bad:
+                        task_lines['badstrings'].append(line)
+                    elif 'MSG' in line:
+                        task_lines['messages'].append(line)
+                    if self.end_blocks_str in line:
+                        task_marks = {k: len(v) for k, v in task_lines.items()}
+
+        # drop whatever was recorded after the last end marker
+        for lines, marks in [(baseline_lines, baseline_marks), (task_lines, task_marks)]:
+            lines['samples'].truncate(marks['samples'])
+            for key in lines.keys() - {'samples'}:
+                del lines[key][marks[key]:]
+        self.asc_lines = {'baseline': baseline_lines, 'task': task_lines}
+
+    def read_edf(self):
+        """
+        read the samples, events and messages of an EyeLink EDF file into the same baseline and task sinks as
+        read_contents, without converting it to ASC (and parsing that text) first. The EDF format is only readable
+        through the SR Research EDF API, which is used through the pyedfread package (version 0.3 or later, which
+        has pyedfread.read_edf and the column names below). Both eyes are kept if both have pupil samples (as for
+        binocular ASC files), otherwise only the one that has.
+        """
+        try:
+            import pyedfread
+        except ImportError:
+            raise Exception('Reading EDF files needs the pyedfread package (and the SR Research EDF API), '
+                            'otherwise convert {} to ASC with edf2asc.'.format(self.filename))
+        # samples: time, gx_left, gx_right, gy_left, gy_right, pa_left, pa_right, ...
+        # events: start, end, type ('fixation', 'saccade', 'blink'), eye (0 = left, 1 = right), ...
+        # messages: time, message
+        samples, events, messages = pyedfread.read_edf(self.filename)
+        required = {'samples': ['time', 'gx_left', 'gx_right', 'gy_left', 'gy_right', 'pa_left', 'pa_right'],
+                    'events': ['start', 'end', 'type', 'eye'], 'messages': ['time', 'message']}
+        missing = ['{} {}'.format(name, x) for name, table in [('samples', samples), ('events', events), ('messages', messages)]
+                   for x in required[name] if x not in table.columns]
+        if missing:
+            raise ValueError('pyedfread {} read {} without the columns: {}. pypil needs pyedfread 0.3 or later, '
+                             'otherwise convert the file to ASC with edf2asc.'.format(
+                                 getattr(pyedfread, '__version__', '(unknown version)'), self.filename, ', '.join(missing)))
+
+        n_pupil = {eye: samples['pa_' + eye].between(0, 1e7, inclusive='neither').sum() for eye in ['left', 'right']}
+        if all(n_pupil.values()):
+            eyes, columns = ['left', 'right'], _SampleSink.binocular_columns
+        else:
+            eyes, columns = [max(n_pupil, key=n_pupil.get)], _SampleSink.columns
+        values = samples[['time'] + [x + eye for eye in eyes for x in ['gx_', 'gy_', 'pa_']]].to_numpy(dtype=float)
+        # the EDF API marks missing values with 1e8 (shown as '.' in the ASC file)
+        values[:, 1:][np.abs(values[:, 1:]) >= 1e7] = np.nan
+        sample_time = values[:, 0]
+        if not hasattr(self, 'eyelinkrate'):
+            self.eyelinkrate = int(round(1000 / np.median(np.diff(sample_time))))
+
+        # messages and (start/end) events as they would appear in the ASC file, in time order
+        lines = [(t, 'MSG\t{} {}\n'.format(int(t), x)) for t, x in zip(messages['time'], messages['message'])]
+        event_names = {'fixation': 'FIX', 'saccade': 'SACC', 'blink': 'BLINK'}
+        for start, end, kind, eye_idx in zip(events['start'], events['end'], events['type'], events['eye']):
+            if kind not in event_names:
+                continue
+            eye_str = 'L' if eye_idx == 0 else 'R'
+            lines.append((start, 'S{} {} {}\n'.format(event_names[kind], eye_str, int(start))))
+            lines.append((end, 'E{} {} {} {} {}\n'.format(event_names[kind], eye_str, int(start), int(end), int(end - start + 1))))
+        lines.sort(key=lambda x: x[0])
+
+        # same sections as in read_contents, the samples of a section are found from its first and last line (a
+        # message comes before the sample of the same time in the ASC file, so that sample belongs to the next line)
+        bad_regex = re.compile('|'.join(re.escape(x) for x in self.bad_strings))
+        baseline_lines = {'samples': _SampleSink(columns), 'badstrings': []}
+        task_lines = {'samples': _SampleSink(columns), 'messages': [], 'badstrings': []}
+        baseline_start = None
+        baseline_badstrings = []
+        task_start = None
+        task_end = None
+        task_marks = {'messages': 0, 'badstrings': 0}
+        self.contain_baseline = 0
+        for t, line in lines:
+            if baseline_start is None and self.start_baseline_str in line:
+                baseline_start = t
                 self.contain_baseline = 1
+            if task_start is None and self.start_blocks_str in line:
+                task_start = t
+            is_bad = bad_regex.search(line) is not None
+            if baseline_start is not None:
+                if is_bad:
+                    baseline_badstrings.append(line)
+                if self.end_baseline_str in line:
+                    # a baseline section is only kept once it is closed
+                    lo, hi = np.searchsorted(sample_time, [baseline_start, t])
+                    baseline_lines['samples'].extend(values[lo:hi], '...')
+                    baseline_lines['badstrings'] += baseline_badstrings
+                    baseline_badstrings = []
+                    baseline_start = None
+            if task_start is not None:
+                if is_bad:
+                    task_lines['badstrings'].append(line)
+                elif line.startswith('MSG'):
+                    task_lines['messages'].append(line)
+                if self.end_blocks_str in line:
+                    task_end = t
+                    task_marks = {key: len(task_lines[key]) for key in task_marks}
+
+        # drop whatever was recorded after the last end marker
+        for key, mark in task_marks.items():
+            del task_lines[key][mark:]
+        if task_end is not None:
+            lo, hi = np.searchsorted(sample_time, [task_start, task_end])
+            task_lines['samples'].extend(values[lo:hi], '...')
+        self.asc_lines = {'baseline': baseline_lines, 'task': task_lines}
+
+    def _read_task_blocks(self):
+        """
+        stream through the ASC file like read_contents, but hand the task over block by block (a block starts at
+        the first message of a new BLOCKID) instead of keeping all of it. Yields, for every block, a pd.DataFrame
+        of its samples plus self.block_margin_ms of the neighbouring blocks on either side (indexed by their
+        position in the whole task), its message lines and the (start, end) time span the block owns. Once the
+        whole file was read, the baseline sinks are in self.asc_lines as after read_contents.
+        """
+        bad_regex = re.compile('|'.join(re.escape(x) for x in self.bad_strings))
+        block_regex = re.compile(r'BLOCKID (\d+)')
+        columns = self._sample_columns()
+        baseline_lines = {'samples': _SampleSink(columns), 'badstrings': []}
+        baseline_marks = dict.fromkeys(baseline_lines, 0)
+        in_baseline = False
+        in_task = False
+        self.contain_baseline = 0
+
+        samples = _SampleSink(columns) # task samples of the current block (and its margins)
+        first_idx = 0 # position of the first of them in the whole task
+        messages = [] # (time, line) of the task messages since the first of these samples
+        block = None
+        own_start = -np.inf
+        boundary = None # time of the first message of the next block, once it was seen
+        end_mark = None # number of task samples and time of the last end marker line
+
+        with open(self.filename, 'r') as f:
+            for line in f:
+                # samples are by far the most common lines and start with the timestamp
+                if line[:1].isdigit():
+                    if in_baseline:
+                        baseline_lines['samples'].append(line)
+                    if in_task:
+                        samples.append(line)
+                    continue
+
+                if not hasattr(self, 'eyelinkrate') and 'RECCFG CR ' in line:
+                    self.eyelinkrate = int(re.search(" (\d{3,4}) ", line).group())
+                if not in_baseline and self.start_baseline_str in line:
+                    in_baseline = True
+                    self.contain_baseline = 1
+                if not in_task and self.start_blocks_str in line:
+                    in_task = True
+                if not (in_baseline or in_task):
+                    continue
+
+                is_bad = bad_regex.search(line) is not None
+                if in_baseline:
+                    if is_bad:
+                        baseline_lines['badstrings'].append(line)
+                    if self.end_baseline_str in line:
+                        baseline_marks = {k: len(v) for k, v in baseline_lines.items()}
+                        in_baseline = False
+                if not in_task or is_bad or not 'MSG' in line:
+                    continue
+
+                line_time = float(line.split()[1])
+                messages.append((line_time, line))
+                match = block_regex.search(line)
+                if match and match.group(1) != block:
+                    if block is not None and boundary is None:
+                        boundary = line_time
+                    block = match.group(1)
+                if self.end_blocks_str in line:
+                    end_mark = (first_idx + len(samples), line_time)
+
+                # hand the current block over once the margin after it was read
+                if boundary is None:
+                    continue
+                samples.flush()
+                if not samples.n or samples.values[samples.n - 1, 0] < boundary + self.block_margin_ms:
+                    continue
+                block_data = samples.to_frame()
+                block_data.index = pd.RangeIndex(first_idx, first_idx + len(block_data))
+                yield block_data, [x for t, x in messages], (own_start, boundary)
+
+                # the next block starts with the margin before its boundary (at a multiple of the downsampling
+                # step, so that the same samples are picked as when the whole task is downsampled at once)
+                keep = np.searchsorted(block_data.time.to_numpy(), boundary - self.block_margin_ms)
+                keep = max(keep - (first_idx + keep) % int(self.eyelinkrate / self.sf), 0)
+                next_samples = _SampleSink(columns)
+                next_samples.extend(samples.values[keep:samples.n], samples.dots[keep:samples.n])
+                samples = next_samples
+                first_idx += keep
+                messages = [(t, x) for t, x in messages if t >= block_data.time.iloc[keep]]
+                own_start = boundary
+                boundary = None
+
+        # drop whatever was recorded after the last end marker
+        baseline_lines['samples'].truncate(baseline_marks['samples'])
+        del baseline_lines['badstrings'][baseline_marks['badstrings']:]
+        self.asc_lines = {'baseline': baseline_lines}
+        if end_mark is None or end_mark[0] <= first_idx:
+            raise Exception('No samples found between {} and {} in {}.'.format(self.start_blocks_str, self.end_blocks_str, self.filename))
+        samples.truncate(end_mark[0] - first_idx)
+        block_data = samples.to_frame()
+        block_data.index = pd.RangeIndex(first_idx, first_idx + len(block_data))
+        yield block_data, [x for t, x in messages if t <= end_mark[1]], (own_start, np.inf)
 
     def organize_baseline(self):
         """
         save message and pupil csv files during baseline
         """
-        if self.contain_baseline:
-            start_baseline = np.where(np.array([self.start_baseline_str in x for x in self.content]))[0]
-            end_baseline = np.where(np.array([self.end_baseline_str in x for x in self.content]))[0]
-            baseline_file = self.content[start_baseline[0]:(end_baseline[-1]+1)]
+        baseline_lines = self.asc_lines.pop('baseline')
         if self.contain_baseline:
             # first save the bad string file
-            self.baseline_badstring_file = pd.Series(baseline_file)[pd.Series(baseline_file).str.contains("|".join(self.bad_strings))]   
+            self.baseline_badstring_file = pd.Series(baseline_lines['badstrings'], dtype=object)
             self.baseline_badstring_file.to_csv(os.path.join(self.data_dir, '{}_baseline_badstring.csv'.format(self.subjectid)), index=False)
-            baseline_file = pd.Series(baseline_file)[~pd.Series(baseline_file).str.contains("|".join(self.bad_strings))]
-            self.baseline_pupil_str = np.array(baseline_file)[['baseline' not in x for x in baseline_file]]
             
-            self.baseline_pupil_data = pd.read_csv(StringIO('\n'.join(self.baseline_pupil_str)), names=[
-                                        'time', 'x', 'y', 'pupil', 'dots'],
-                                        usecols=['time', 'x', 'y', 'pupil', 'dots'], na_values=['   .'], sep='\t', engine='python')
+            self.baseline_pupil_data = baseline_lines['samples'].to_frame()
             self.baseline_pupil_data.to_csv(os.path.join(self.data_dir, '{}_baseline_pupil_RAW.csv'.format(self.subjectid)), index=False) 
 
     # this function is also task specific
@@ -95,24 +842,34 @@ class pypil(object):
         """
         save message and pupil csv files
         """
-
-        start_blocks = np.where(np.array([self.start_blocks_str in x for x in self.content]))[0]
-        end_blocks = np.where(np.array([self.end_blocks_str in x for x in self.content]))[0]
-        small_file = self.content[start_blocks[0]:(end_blocks[-1]+1)]
+        task_lines = self.asc_lines.pop('task')
+        if not task_lines['samples']:
+            raise Exception('No samples found between {} and {} in {}.'.format(self.start_blocks_str, self.end_blocks_str, self.filename))
         
         # first save the bad string file in case future analysis need
-        self.small_badstring_file = pd.Series(small_file)[pd.Series(small_file).str.contains("|".join(self.bad_strings))]   
+        # (fixation, saccade, and blink messages were already kept apart in read_contents)
+        self.small_badstring_file = pd.Series(task_lines['badstrings'], dtype=object)
         self.small_badstring_file.to_csv(os.path.join(self.data_dir, '{}_badstring.csv'.format(self.subjectid)), index=False)
         
-        # Remove all of the fixation, saccade, and blink messages
-        small_file = pd.Series(small_file)[~pd.Series(small_file).str.contains("|".join(self.bad_strings))]
-        
         # Extract, Fix, and Save Messages
         
-        self.messages = np.array(small_file)[['MSG' in x for x in small_file]] # previously MSG
+        self.messages = task_lines['messages']
+        self.message_data = self._parse_messages(self.messages)
+        self.message_data.to_csv(os.path.join(self.data_dir, '{}_message_RAW.csv'.format(self.subjectid)), index=False)
+
+        
+        # Extract, Fix, and Save Pupil Data
+        self.pupil_data = task_lines['samples'].to_frame()
+        self.pupil_data.to_csv(os.path.join(self.data_dir, '{}_pupil_RAW.csv'.format(self.subjectid)), index=False) # not quite sure how I get away with all the drift correct?
+        # self.merged_data.ffill(inplace=True) 
+        
+    def _parse_messages(self, messages):
+        """
+        parse the task MSG lines into the message data (BLOCKID and TRIALID are NaN for messages without them)
+        """
         self.message_str = []
 
-        for line in self.messages:
+        for line in messages:
             # add blockid and trialid
             if not 'BLOCKID' in line:
                 split_strings = line.split()
@@ -128,45 +885,93 @@ class pypil(object):
                     line = ' '.join(split_strings)
             self.message_str.append(line)
 
-        self.message_data = pd.read_csv(StringIO('\n'.join(self.message_str)), names=[
+        message_data = pd.read_csv(StringIO('\n'.join(self.message_str)), names=[
                                           'MSG', 'time', 'BLOCKID_text', 'BLOCKID', 'TRIALID_text', 'TRIALID', 'event', 'action', \
                                               'ph1', 'ph2', 'ph3', 'ph4', 'ph5', 'ph6', 'ph7', 'ph8'], # placeholder to have enough entries so that it wont throw errors
                                           na_values=['nan'], sep=' |\t', engine='python')
         # replace 999 with NaN
-        self.message_data['BLOCKID'] = self.message_data['BLOCKID'].replace(999, np.nan)
-        self.message_data['TRIALID'] = self.message_data['TRIALID'].replace(999, np.nan)
-        self.message_data.to_csv(os.path.join(self.data_dir, '{}_message_RAW.csv'.format(self.subjectid)), index=False)
+        message_data['BLOCKID'] = message_data['BLOCKID'].replace(999, np.nan)
+        message_data['TRIALID'] = message_data['TRIALID'].replace(999, np.nan)
+        return message_data
 
-        
-        # Extract, Fix, and Save Pupil Data
-        self.pupil_str = np.array(small_file)[['MSG' not in x for x in small_file]]
-        self.pupil_data = pd.read_csv(StringIO('\n'.join(self.pupil_str)), names=[
-                                        'time', 'x', 'y', 'pupil', 'dots'],
-                                        usecols=['time', 'x', 'y', 'pupil', 'dots'], na_values=['None'], sep='\t', engine='python')
-        self.pupil_data.to_csv(os.path.join(self.data_dir, '{}_pupil_RAW.csv'.format(self.subjectid)), index=False) # not quite sure how I get away with all the drift correct?
-        # self.merged_data.ffill(inplace=True) 
-        
     def down_sample(self):
         """
-        downsample data to a frequency of self.sf from self.eyelinkrate
+        downsample data to a frequency of self.sf from self.eyelinkrate, either by picking every eyelinkrate/sf-th
+        sample (self.down_sample_method = 'pick') or with an anti-aliasing polyphase filter ('polyphase', see
+        _resample_poly). The full-rate data are only kept (as *_raw attributes) if self.keep_raw_data is True.
+        Note that the polyphase filter also removes part of the sample-to-sample noise that the threshold of the
+        speed filter scales with (its MAD), so the filter phase rejects more samples than after 'pick': the valid
+        fraction of a 1000 Hz test recording dropped from 0.886 to 0.863, mostly away from missing data
         """
-        self.pupil_data_raw = self.pupil_data.copy(deep=True)
-        self.pupil_data = self.pupil_data.loc[pd.RangeIndex(
-            self.pupil_data.index[0], self.pupil_data.index[-1], step=int(self.eyelinkrate / self.sf))]
-        self.pupil_data.reset_index(inplace=True)
-        self.pupil_data.to_csv(os.path.join(self.data_dir, '{}_pupil_RAW_downsample.csv'.format(self.subjectid)), index=False)
-
-        self.merged_data_raw = self.merged_data.copy(deep=True)
-        self.merged_data = self.merged_data.loc[pd.RangeIndex(
-            self.merged_data.index[0], self.merged_data.index[-1], step=int(self.eyelinkrate / self.sf))]
-        self.merged_data.reset_index(inplace=True)
-        self.merged_data.to_csv(os.path.join(self.data_dir, '{}_merged_pupil_RAW_downsample.csv'.format(self.subjectid)), index=False)
-        
-        self.baseline_pupil_data_raw = self.baseline_pupil_data.copy(deep=True)
-        self.baseline_pupil_data = self.baseline_pupil_data.loc[pd.RangeIndex(
-            self.baseline_pupil_data.index[0], self.baseline_pupil_data.index[-1], step=int(self.eyelinkrate/self.sf))]
-        self.baseline_pupil_data.reset_index(inplace=True)
-        self.baseline_pupil_data.to_csv(os.path.join(self.data_dir, '{}_baseline_pupil_RAW_downsample.csv'.format(self.subjectid)), index=False)
+        for data_name, file_name in [('pupil_data', 'pupil_RAW'), ('merged_data', 'merged_pupil_RAW'),
+                                     ('baseline_pupil_data', 'baseline_pupil_RAW')]:
+            if not hasattr(self, data_name):
+                continue
+            data = getattr(self, data_name)
+            if self.keep_raw_data:
+                setattr(self, data_name + '_raw', data.copy(deep=True))
+
+            if self.down_sample_method == 'polyphase':
+                data = self._resample_poly(data)
+            else:
+                data = data.loc[pd.RangeIndex(data.index[0], data.index[-1], step=int(self.eyelinkrate / self.sf))]
+            data.reset_index(inplace=True)
+            setattr(self, data_name, data)
+            if self.write_raw_csv:
+                self._csv_ready(data).to_csv(os.path.join(self.data_dir, '{}_{}_downsample.csv'.format(self.subjectid, file_name)), index=False)
+
+    def _resample_poly(self, df, resample_cols=['x', 'y', 'pupil', 'x_left', 'y_left', 'pupil_left',
+                                                'x_right', 'y_right', 'pupil_right']):
+        """
+        Resample df from self.eyelinkrate to self.sf (any rational ratio) with scipy.signal.resample_poly, which
+        applies an anti-aliasing low pass filter before decimating. Every continuous stretch of recording (no
+        time gap) is resampled on its own. Missing samples (NaN, or 0 for the pupil) are linearly interpolated
+        before filtering and set back to missing where the resampled missing mask exceeds one half: a missing
+        stretch becomes the new samples that fall within it (it does not spread to its neighbours), and stretches
+        shorter than about half the new sampling interval are filled in.
+
+        Columns in resample_cols are filtered, all the others take the value of the nearest original sample,
+        whose index label is used as the new index.
+        """
+        ratio = (Fraction(self.sf) / Fraction(self.eyelinkrate)).limit_denominator(1000)
+        up, down = ratio.numerator, ratio.denominator
+        step_ms = 1000 / self.eyelinkrate
+        resample_cols = [col for col in resample_cols if col in df.columns]
+
+        time = df.time.to_numpy()
+        values = {col: df[col].to_numpy(dtype=float) for col in resample_cols}
+        breaks = np.flatnonzero(np.diff(time) > 1.5 * step_ms) + 1
+        bounds = np.concatenate([[0], breaks, [len(time)]])
+
+        new_time, nearest = [], []
+        new_values = {col: [] for col in resample_cols}
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            n_out = -(-(end - start) * up // down)
+            # position of each new sample in the original segment
+            position = np.arange(n_out) * down / up
+            new_time.append(time[start] + position * step_ms)
+            nearest.append(start + np.minimum(np.round(position).astype(int), end - start - 1))
+
+            for col in resample_cols:
+                fill = 0. if col.startswith('pupil') else np.nan
+                segment = values[col][start:end]
+                missing = np.isnan(segment) | (segment == fill)
+                if missing.all():
+                    new_values[col].append(np.full(n_out, fill))
+                    continue
+                idx = np.arange(len(segment))
+                segment = np.interp(idx, idx[~missing], segment[~missing])
+                resampled = signal.resample_poly(segment, up, down, padtype='line')
+                resampled[signal.resample_poly(missing.astype(float), up, down) > .5] = fill
+                new_values[col].append(resampled)
+
+        nearest = np.concatenate(nearest)
+        new_time = np.concatenate(new_time)
+        resampled_df = df.iloc[nearest].copy()
+        resampled_df['time'] = new_time.astype(time.dtype) if np.array_equal(new_time, np.round(new_time)) else new_time
+        for col in resample_cols:
+            resampled_df[col] = np.concatenate(new_values[col]).astype(df[col].dtype)
+        return resampled_df
 
     # def interpolate(self):
     #     """
@@ -182,78 +987,249 @@ class pypil(object):
     #     else:
     #         self.merged_data.inter_pupil.interpolate(inplace=True)
 
+    def _compact(self, df):
+        '''
+        cast the columns of df listed in self.compact_dtypes to their memory-lean dtype (in place) and return df
+        '''
+        for col, dtype in self.compact_dtypes.items():
+            if col not in df.columns:
+                continue
+            if dtype == np.float32 and df[col].dtype == object:
+                # older csv files kept the EyeLink '.' missing marker as a string
+                df[col] = pd.to_numeric(df[col], errors='coerce')
+            df[col] = df[col].astype(dtype)
+        return df
+
+    def _csv_ready(self, df):
+        '''
+        return a shallow copy of df with the compact integer columns (block, trial) back as float, so the csv files
+        keep writing them as 1.0/0.0 as before _compact: the notebooks and R scripts rebuild the identifier from them
+        '''
+        int_cols = [col for col, dtype in self.compact_dtypes.items() if dtype == 'Int16' and col in df.columns]
+        if not int_cols:
+            return df
+        df = df.copy(deep=False)
+        for col in int_cols:
+            df[col] = df[col].astype(float)
+        return df
+
     def read_data(self):
         """
-        read in cleaned message, pupil and merged data
+        read in cleaned message and (downsampled) pupil, merged and baseline data
         Haoxue Aug: in theory we do not need this part since it should be taken care of in the wrapper prepare_data()
         """
+        if self.read_cache():
+            return
+
         try:
             self.message_data = pd.read_csv(os.path.join(self.data_dir, '{}_message_RAW.csv'.format(self.subjectid)))
-            self.pupil_data = pd.read_csv(os.path.join(self.data_dir, '{}_pupil_RAW.csv'.format(self.subjectid)))
-            self.merged_data = pd.read_csv(os.path.join(self.data_dir, '{}_merged_pupil_RAW.csv'.format(self.subjectid)))
+            self.pupil_data = pd.read_csv(os.path.join(self.data_dir, '{}_pupil_RAW_downsample.csv'.format(self.subjectid)))
+            self.merged_data = pd.read_csv(os.path.join(self.data_dir, '{}_merged_pupil_RAW_downsample.csv'.format(self.subjectid)))
+            self._compact(self.pupil_data)
+            self._compact(self.merged_data)
         except:
             raise Exception('At least one data file does not exist in the current folder. Please double check and/or rerun the pipeline.')
 
         try:
-            self.baseline_pupil_data = pd.read_csv(os.path.join(self.data_dir, '{}_baseline_pupil_RAW.csv'.format(self.subjectid)))
+            self.baseline_pupil_data = self._compact(pd.read_csv(os.path.join(self.data_dir, '{}_baseline_pupil_RAW_downsample.csv'.format(self.subjectid))))
         except:
             raise Exception('There is no baseline_pupil_data in the current folder. Please double check and/or rerun the pipeline.')
            
+    def source_signature(self, cache_info=None):
+        """
+        return size, modification time and content hash of the ASC file. If cache_info already holds
+        the same size and modification time, its hash is reused instead of reading the file again
+        """
+        stat = os.stat(self.filename)
+        signature = {'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns}
+        if cache_info and all(cache_info.get(k) == v for k, v in signature.items()):
+            signature['source_hash'] = cache_info['source_hash']
+            return signature
+
+        sha1 = hashlib.sha1()
+        with open(self.filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                sha1.update(chunk)
+        signature['source_hash'] = sha1.hexdigest()
+        return signature
+
+    def prepare_key(self):
+        """
+        hash of the settings that shape the output of prepare_phase (the ASC file itself is checked by source_signature)
+        """
+        return hash_settings(self.sf, self.down_sample_method, self.event_list, self.bad_strings, self.start_baseline_str,
+                             self.end_baseline_str, self.start_blocks_str, self.end_blocks_str)
+
+    def cache_status(self):
+        """
+        return 'current' if the binary cache was written from the current content of the ASC file with the
+        current prepare settings, 'stale' if either changed since, and 'missing' if there is no cache
+        """
+        try:
+            with open(os.path.join(self.cache_dir, 'cache_info.json'), 'r') as f:
+                cache_info = json.load(f)
+        except (OSError, ValueError):
+            return 'missing'
+        if self.source_signature(cache_info)['source_hash'] != cache_info.get('source_hash') or \
+                self.prepare_key() != cache_info.get('prepare_key'):
+            return 'stale'
+        return 'current'
+
+    def write_cache(self):
+        """
+        write message, pupil, merged and baseline data (whichever exist) to a binary columnar cache
+        (one .npy file per column in self.cache_dir, see write_columns), tagged with the content hash of the ASC file and the prepare_key.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cache_info = self.source_signature()
+        cache_info['prepare_key'] = self.prepare_key()
+        cache_info['tables'] = {}
+        for table in self.cache_tables:
+            if not isinstance(getattr(self, table, None), pd.DataFrame):
+                continue
+            cache_info['tables'][table] = write_columns(os.path.join(self.cache_dir, table), getattr(self, table))
+
+        # the info file goes last, so an interrupted write leaves no valid cache behind
+        with open(os.path.join(self.cache_dir, 'cache_info.json'), 'w') as f:
+            json.dump(cache_info, f)
+
+    def read_cache(self):
+        """
+        load message, pupil, merged and baseline data from the binary cache written by write_cache.
+        Returns False, without loading anything, if the cache is missing or the ASC file changed since it was written.
+        """
+        if self.cache_status() != 'current':
+            return False
+        with open(os.path.join(self.cache_dir, 'cache_info.json'), 'r') as f:
+            cache_info = json.load(f)
+
+        for table, columns in cache_info['tables'].items():
+            setattr(self, table, read_columns(os.path.join(self.cache_dir, table), columns))
+        return True
+
+    def stage_key(self, stage, for_baseline=False):
+        """
+        key of the output of stage ('filter' or 'process'): a hash of its input data plus the settings it uses.
+        The input of the filter stage is the time and pupil column(s) (see _pupil_columns) of self.merged_data;
+        the input of the process stage is the output of the filter stage, so its key is chained to the filter key,
+        plus the block column when the 'segments' smoothing mode splits the segments at block changes.
+        """
+        if stage == 'filter':
+            return hash_settings(stage, for_baseline, self.merged_data[['time'] + self._pupil_columns()],
+                                 self.stage_settings(stage))
+        inputs = [self.filter_key]
+        if self.interp_settings.get('smoothing_mode') == 'segments' and self.interp_settings.get('split_blocks') \
+                and 'block' in self.merged_data.columns:
+            inputs.append(self.merged_data['block'])
+        return hash_settings(stage, for_baseline, *inputs, self.stage_settings(stage))
+
+    def stage_settings(self, stage):
+        """
+        the settings of stage ('filter' or 'process') that its output depends on: self.filter_settings or
+        self.interp_settings without the ones in self.unkeyed_settings (diagnostics, number of threads)
+        """
+        settings = self.filter_settings if stage == 'filter' else self.interp_settings
+        return {x: settings[x] for x in settings if x not in self.unkeyed_settings}
+
+    def write_stage(self, stage, key):
+        """
+        store the columns that stage added to self.merged_data (see self.stage_columns), and its other tables
+        (self.stage_tables), under self.cache_dir/stages/<stage>_<key>, so a later run with the same input and
+        settings can reuse them
+        """
+        directory = os.path.join(self.cache_dir, 'stages', '{}_{}'.format(stage, key))
+        cols = [x for x in self.stage_columns[stage] if x in self.merged_data.columns]
+        stage_info = {'stage': stage, 'key': key, 'n_samples': len(self.merged_data),
+                      'columns': write_columns(directory, self.merged_data[cols]), 'tables': {}}
+        for table in self.stage_tables[stage]:
+            if isinstance(getattr(self, table, None), pd.DataFrame):
+                stage_info['tables'][table] = write_columns(os.path.join(directory, table), getattr(self, table))
+        # the info file goes last, so an interrupted write leaves no valid stage behind
+        with open(os.path.join(directory, 'stage_info.json'), 'w') as f:
+            json.dump(stage_info, f)
+
+    def read_stage(self, stage, key):
+        """
+        add the columns stored by write_stage to self.merged_data (and load its tables). Returns False, without
+        changing anything, if there is no stored output for this stage and key.
+        """
+        directory = os.path.join(self.cache_dir, 'stages', '{}_{}'.format(stage, key))
+        try:
+            with open(os.path.join(directory, 'stage_info.json'), 'r') as f:
+                stage_info = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if stage_info['n_samples'] != len(self.merged_data):
+            return False
+        stage_data = read_columns(directory, stage_info['columns'])
+        for col in stage_data.columns:
+            self.merged_data[col] = stage_data[col].to_numpy()
+        for table in self.stage_tables[stage]:
+            columns = stage_info.get('tables', {}).get(table)
+            setattr(self, table, read_columns(os.path.join(directory, table), columns) if columns else None)
+        return True
+
+    def _nearest_sample_idx(self, times):
+        '''
+        Return the positions in self.pupil_data of the samples closest in time to each of times (ties go
+        to the earlier sample, as with idxmin). Uses a binary search, so self.pupil_data.time must be sorted.
+        '''
+        sample_time = self.pupil_data.time.to_numpy()
+        assert (np.all(np.diff(sample_time) >= 0)
+                ), "Pupil time stamps must be sorted to be matched with the messages"
+        times = np.asarray(times, dtype=float)
+        right = np.clip(np.searchsorted(sample_time, times, side='left'), 1, max(len(sample_time) - 1, 1))
+        left = right - 1
+        choose_left = np.abs(times - sample_time[left]) <= np.abs(sample_time[right] - times)
+        return np.where(choose_left, left, right)
+
     def mess_pupil_merge2(self):
         '''
         merge pupil and message data
         Note: the name has '2' in due to that in an early version we want to distinguish this file with Deshawn's version where deep/shallow copy was not distinguished
         '''
 
-        print('This will take some time...')
-        
         self.message_data_trial_start = self.message_data[self.message_data.event == 'fixation_onset']
-        self.message_data_trial_start = self.message_data_trial_start.append(self.message_data.tail(1)) # append will be deprecated in the future
+        self.message_data_trial_start = pd.concat([self.message_data_trial_start, self.message_data.tail(1)])
 
         # generate merged data file with same rows as the puil data (not fillin the pupil data yet)
         # in my data, I also did not put in the behavioral data / task attribute here yet.
-        self.merged_data = pd.DataFrame(columns=['ID', 'block', 'trial', 'event', 'time_step'], 
-                                        index=self.pupil_data.index)
-        # fill in the subjectid                                    
-        self.merged_data.ID.iloc[0] = self.subjectid
-
-        for idx in range(self.message_data_trial_start.shape[0]-1):
-            # get block and trial info from message data
-            curr_b, curr_t = self.message_data_trial_start.iloc[idx][['BLOCKID','TRIALID']]
-            trial_time_range = \
-                [self.message_data_trial_start.iloc[idx]['time'], \
-                    self.message_data_trial_start.iloc[idx+1]['time']]
-            trial_idx_range = \
-                pd.RangeIndex(self.pupil_data.time.sub(trial_time_range[0]).abs().idxmin(),\
-                    self.pupil_data.time.sub(trial_time_range[1]).abs().idxmin())
-
-            self.merged_data.block.loc[trial_idx_range] = curr_b
-            self.merged_data.trial.loc[trial_idx_range] = curr_t
+        n_samples = self.pupil_data.shape[0]
+        sample_idx = np.arange(n_samples)
+
+        # a trial runs from the sample closest to its fixation onset up to (not including) the sample
+        # closest to the next fixation onset (or to the last message for the last trial)
+        trial_edges = self._nearest_sample_idx(self.message_data_trial_start.time)
+        trial_starts, trial_ends = trial_edges[:-1], trial_edges[1:]
+        trial_idx = np.searchsorted(trial_starts, sample_idx, side='right') - 1
+        in_trial = trial_idx >= 0
+        in_trial[in_trial] = sample_idx[in_trial] < trial_ends[trial_idx[in_trial]]
+
+        block = np.full(n_samples, np.nan)
+        trial = np.full(n_samples, np.nan)
+        block[in_trial] = self.message_data_trial_start.BLOCKID.to_numpy()[trial_idx[in_trial]]
+        trial[in_trial] = self.message_data_trial_start.TRIALID.to_numpy()[trial_idx[in_trial]]
 
         # Haoxue Aug 1: the start index and end index of each trial is good. However when it comes to event locked, sometimes event will be missed since it can not find the exact time lock
+        # each event is marked on the sample closest to its message (later events in self.event_list win ties)
+        event = np.full(n_samples, np.nan, dtype=object)
         for individual_event in self.event_list:
             individual_time = self.message_data.time[self.message_data.event == individual_event]
-            individual_idx = [self.pupil_data.time.sub(x).abs().idxmin() for x in individual_time]
-            # # for the future: should change how much it increases after 
-            # individual_idx = pd.RangeIndex([self.pupil_data.time.sub(x).abs().idxmin() for x in individual_time,\
-            #     self.pupil_data.time.sub(x).abs().idxmin()+4 for x in individual_time])
-            
-            # not sure why Deshawn wants it to be one option and one option plus one.  - Aug 1 Now I think I know.
-            # I wonder what is the structure of individual_idx... 
-            # I guess I could change it later if needed.
-                # pd.RangeIndex([self.pupil_data.time.sub(individual_time).abs().idxmin(),\
-                #     self.pupil_data.time.sub(individual_time).abs().idxmin()+1])
+            event[self._nearest_sample_idx(individual_time)] = individual_event
 
-            self.merged_data.event.loc[self.pupil_data.index.isin(individual_idx)] = individual_event
+        self.merged_data = pd.DataFrame({'ID': self.subjectid, 'block': block, 'trial': trial,
+                                         'event': event, 'time_step': np.nan},
+                                        index=self.pupil_data.index)
 
         self.merged_data.ffill(inplace=True)
         # after entering the fields according to the behavioral data (setting), merge it with pupil data (size goes up)
-        self.merged_data = self.pupil_data.join(self.merged_data)
+        self.merged_data = self._compact(self.pupil_data.join(self.merged_data))
         # only save the part from the start of the first trial to the end of the last trial
         # self.merged_data = self.merged_data.loc[pd.RangeIndex(inds[0][0][0], inds[-1][-1][-1])]
         self.indclude_pupil = True
         #self.merged_data.corrected_pupil = self.merged_data.inter_pupil / self.merged_data.inter_pupil.mean()
-        self.merged_data.to_csv(os.path.join(self.data_dir, '{}_merged_pupil_RAW.csv'.format(self.subjectid)), index=False)
+        if self.write_raw_csv:
+            self._csv_ready(self.merged_data).to_csv(os.path.join(self.data_dir, '{}_merged_pupil_RAW.csv'.format(self.subjectid)), index=False)
 
     def prepare_phase(self, overwrite=False):
         '''
@@ -274,16 +1250,20 @@ class pypil(object):
         self.merged_data can have more properties but these should be a minimum.
 
         '''
-        self.overwrite = overwrite
+        self.overwrite = bool(overwrite)
         if not hasattr(self, 'merged_data') or not isinstance(self.merged_data, pd.DataFrame):
             'Need to raise and assertion here because you need to have a pd.DataFrame called merged_data'
         elif not all(pd.Series(['time', 'pupil']).isin(self.merged_data.columns)):
             'Another assertion you need to have the following columns in your data frame\'time\' and \'pupil\''
 
+        # the ASC file is only parsed again when it or the settings in prepare_key changed since the binary
+        # cache was written (or when neither the cache nor the csv files are there)
+        cache_status = self.cache_status()
         if (not all([os.path.exists(os.path.join(self.data_dir, '{}_message_RAW.csv'.format(self.subjectid))),\
-            os.path.exists(os.path.join(self.data_dir, '{}_pupil_RAW.csv'.format(self.subjectid))),\
-                os.path.exists(os.path.join(self.data_dir, '{}_merged_pupil_RAW.csv'.format(self.subjectid))),\
-                    os.path.exists(os.path.join(self.data_dir, '{}_baseline_pupil_RAW.csv'.format(self.subjectid)))])) or self.overwrite:
+            os.path.exists(os.path.join(self.data_dir, '{}_pupil_RAW_downsample.csv'.format(self.subjectid))),\
+                os.path.exists(os.path.join(self.data_dir, '{}_merged_pupil_RAW_downsample.csv'.format(self.subjectid))),\
+                    os.path.exists(os.path.join(self.data_dir, '{}_baseline_pupil_RAW_downsample.csv'.format(self.subjectid)))]) \
+                        and cache_status != 'current') or cache_status == 'stale' or self.overwrite:
             self.read_contents()
             self.organize_baseline()
             self.organize_contents()
@@ -294,10 +1274,13 @@ class pypil(object):
             self.mess_pupil_merge2()
             # Haoxue: I believe that downsample is mostly because we want to save computational resource. currently move it down mess_puipl_merge2 and see how it goes.
             self.down_sample()
+            self.write_cache()
         else:
             print('{} data EXISTED'.format(self.subjectid))
 
             self.read_data()
+            if cache_status == 'missing':
+                self.write_cache()
 
     def default_filter_settings(self):
         '''
@@ -397,8 +1380,10 @@ class pypil(object):
         # Keep filter data:
 
         # The following flag enables/disables the storage of the intermediate
-        # filter data, set to false to save memory and improve plotting
-        # performance:
+        # filter data (the speed filter output in self.filter_data and the
+        # residuals, trendlines and valid samples of every deviation filter
+        # pass in self.smoothed_per_pass, as float32/bool), set to false to
+        # save memory and improve plotting performance:
         filter_settings['keep_filter_data'] = True
 
         # ----------------------------------------------------------------------
@@ -407,14 +1392,17 @@ class pypil(object):
 
     def filter_phase(self, overwrite=None, for_baseline=False):
         '''
-        Completes the filter phase of Kret & Sjak-Shie (2018). At present it is only able to
-        work with a single pupil (either left or right) not both simultaneously. Broken up
-        into three steps.
+        Completes the filter phase of Kret & Sjak-Shie (2018). Works with a single pupil (either left or right)
+        or, for binocular recordings, with both, which are filtered simultaneously and then combined into their
+        mean (see mean_pupil). Broken up into three steps.
 
         Step 1: Remove missing and out-of-bound samples
         Step 2: Blink detection via speed filtering
         Step 3: Outliers rejection via residual analysis
 
+        The output is stored per input data and self.filter_settings (see stage_key), so running it again on the
+        same data with the same settings only loads the stored output (unless overwrite).
+
         Returns a boolean pandas.Series indicating whether or not the each sample is valid
         '''
         try:
@@ -422,53 +1410,92 @@ class pypil(object):
         except Exception:
             self.default_filter_settings()
 
-        if overwrite:
-            self.overwrite = overwrite
-
-        if for_baseline:
-            flag_nonexist = (not os.path.exists(os.path.join(self.data_dir, '{}_merged_pupil_baseline.csv'.format(self.subjectid))))
-        else:
-            flag_nonexist = (not os.path.exists(os.path.join(self.data_dir, '{}_merged_pupil.csv'.format(self.subjectid))))
-        if  flag_nonexist or self.overwrite:
-            # Adding the to be interpolated pupil data and is valid column to df.
-            self.merged_data['inter_pupil'] = self.merged_data.pupil
-            # Technically don't need this because done in step 1
-            # Haoxue: can confirm with this. also could prefer to leave it here for now just to play safe.
-            self.merged_data.inter_pupil.replace(0, np.NaN, inplace=True)
-
-            self.merged_data['is_valid'] = self.merged_data.inter_pupil.notna()
-
-            # Step 1: Remove Out-of-Bounds Samples:
-
-            # Remove samples that are larger or smaller than the criteria:
-            self._remove_out_of_bounds()
-
-            # Step 2: Blink Detection via Speed Filter:
-
-            # Remove blinks and other artifacts that exhibit large differences between samples:
-            self._mad_speed_filter()
-            # [isValid, speedFiltData] = madSpeedFilter(t_ms, diaSamples, isValid, rawFiltSettings)
+        self.overwrite = bool(overwrite)
 
-            # Step 3: Outlier Rejection via Residuals Analysis:
+        # the filter output is reused whenever the same pupil data were filtered with the same settings before
+        self.filter_key = self.stage_key('filter', for_baseline)
+        if self.overwrite or not self.read_stage('filter', self.filter_key):
+            self._filter()
+            self.write_stage('filter', self.filter_key)
 
-            # Remove outliers that exhibit a large deviation from a smooth trendline:
-            self._mad_deviation_filter2()
-            # [isValid, devFiltData] = madDeviationFilter(t_ms, diaSamples, isValid, rawFiltSettings)
+    def _pupil_columns(self):
+        '''
+        the pupil column(s) of self.merged_data the filter phase works on: pupil_left and pupil_right for binocular
+        recordings, pupil otherwise
+        '''
+        binocular = ['pupil_left', 'pupil_right']
+        return binocular if set(binocular) <= set(self.merged_data.columns) else ['pupil']
 
-            # Assign output:
-            self.merged_data.inter_pupil = np.where(self.merged_data.is_valid, self.merged_data.pupil, np.NaN)
+    def _filter(self):
+        '''
+        the filter phase on self.merged_data (adds the inter_pupil, is_valid and valid_time columns, and the
+        is_valid_left and is_valid_right columns of binocular recordings)
+        '''
+        # Adding the to be interpolated pupil data and is valid column to df.
+        self.merged_data['inter_pupil'] = self.merged_data.pupil
+        # Technically don't need this because done in step 1
+        # Haoxue: can confirm with this. also could prefer to leave it here for now just to play safe.
+        self.merged_data.inter_pupil.replace(0, np.NaN, inplace=True)
+
+        self.merged_data['is_valid'] = self.merged_data.inter_pupil.notna()
+
+        # the two eyes of binocular recordings are filtered together, on their shared time stamps
+        pupil_cols = self._pupil_columns()
+        valid_cols = [x.replace('pupil', 'is_valid') for x in pupil_cols]
+        if len(pupil_cols) > 1:
+            pupil = self.merged_data[pupil_cols].to_numpy()
+            is_valid = ~np.isnan(pupil) & (pupil != 0)
         else:
-            if for_baseline:
-                self.merged_data = pd.read_csv(os.path.join(self.data_dir, '{}_merged_pupil_baseline.csv'.format(self.subjectid)))
+            pupil = self.merged_data.pupil.to_numpy()
+            is_valid = self.merged_data.is_valid.to_numpy()
+
+        # Step 1: Remove Out-of-Bounds Samples
+        # Step 2: Blink Detection via Speed Filter
+        # Step 3: Outlier Rejection via Residuals Analysis
+        # (done on plain arrays by filter_samples)
+        is_valid, speed_data, passes = filter_samples(self.merged_data.time.to_numpy(), pupil, is_valid, self.filter_settings)
+
+        # Set output (the full-length diagnostics only if keep_filter_data):
+        self.filter_data = {x: speed_data[x] for x in ['mad', 'med_d', 'thresh']}
+        self.smoothed_per_pass = None
+        if self.filter_settings['keep_filter_data']:
+            if pupil.ndim > 1:
+                self.filter_data['max_dilation_speeds'] = pd.DataFrame(speed_data['max_dilation_speeds'].astype(np.float32),
+                                                                       index=self.merged_data.index, columns=pupil_cols)
+                self.filter_data['is_valid'] = pd.DataFrame(speed_data['is_valid'], index=self.merged_data.index, columns=valid_cols)
             else:
-                self.merged_data = pd.read_csv(os.path.join(self.data_dir, '{}_merged_pupil.csv'.format(self.subjectid)))
-            
+                idx, max_dilation_speeds = speed_data['max_dilation_speeds']
+                self.filter_data['max_dilation_speeds'] = pd.Series(max_dilation_speeds.astype(np.float32),
+                                                                    index=self.merged_data.index[idx])
+                self.filter_data['is_valid'] = pd.Series(speed_data['is_valid'], index=self.merged_data.index, name='is_valid')
+            # one column per pass and eye (e.g. resid0, or resid0_left and resid0_right)
+            suffixes = [x[len('pupil'):] for x in pupil_cols]
+            self.smoothed_per_pass = pd.DataFrame({'{}{}{}'.format(y, pass_ind, suffix): x_eye
+                                                   for pass_ind, pass_data in enumerate(passes)
+                                                   for y, x in zip(['resid', 'smooth', 'is_valid'], pass_data)
+                                                   for suffix, x_eye in zip(suffixes, x.reshape(len(x), -1).T)},
+                                                  index=self.merged_data.index)
+
+        if pupil.ndim > 1:
+            for col, eye_valid in zip(valid_cols, is_valid.T):
+                self.merged_data[col] = eye_valid
+            # Combine the valid samples of both eyes into a single pupil, which is processed from here on
+            inter_pupil, is_valid = mean_pupil(pupil, is_valid)
+        else:
+            inter_pupil = np.where(is_valid, self.merged_data.pupil, np.NaN)
 
+        self.merged_data['is_valid'] = is_valid
+        self.merged_data['valid_time'] = np.where(is_valid, self.merged_data.time, np.NaN)
+        self.valid_time = self.merged_data.time[is_valid]
+
+        # Assign output:
+        self.merged_data.inter_pupil = inter_pupil
 
     def process_valid_samples(self, overwrite=None, for_baseline=False):
         '''
-        Completes the process valid samples phase of Kret & Sjak-Shie (2018). At present it is only able to
-        work with a single pupil (either left or right) not both simultaneously. Broken up into two steps.
+        Completes the process valid samples phase of Kret & Sjak-Shie (2018) on the valid samples of the
+        single pupil or, for binocular recordings, of the mean of both pupils (inter_pupil, see filter_phase), so
+        the gaps and the smoothing are only computed once. Broken up into two steps.
 
         Step 1: Evaluate valid samples
         Step 2: Interpolate and smooth invalid samples were possible
@@ -477,6 +1504,9 @@ class pypil(object):
         containing time stamps WITHOUT missing data or time gaps (i.e., a continuous time series), pupil data,
         and the corresponding valid samples as determined by the filtering phase.
 
+        As for filter_phase, the output is stored per filter output and self.interp_settings and reused if
+        they did not change (unless overwrite).
+
         Returns a boolean pandas.Series with the smoothed pupil data and time series
         '''
         self.valid_fraction = self.merged_data.is_valid.mean()
@@ -486,14 +1516,16 @@ class pypil(object):
         except Exception:
             self.default_interp_settings()
 
-        if overwrite:
-            self.overwrite = overwrite
+        self.overwrite = bool(overwrite)
 
-        if (not ('smoothed_interp_pupil_corrected' in self.merged_data.columns and \
-            'inter_pupil_corrected' in self.merged_data.columns)) or self.overwrite:
-            self._interp_and_smooth(for_baseline)
+        # reused whenever the same filter output was processed with the same settings before
+        self.process_key = self.stage_key('process', for_baseline)
+        if self.overwrite or not self.read_stage('process', self.process_key):
+            self._interp_and_smooth()
+            self.write_stage('process', self.process_key)
         else:
             self.include_pupil = True
+        self.write_processed(for_baseline)
 
     def default_interp_settings(self, upsample=250):
         '''
@@ -511,6 +1543,12 @@ class pypil(object):
 
         interp_settings['interp_upsampling_freq'] = upsample
 
+        # Set to True to smooth on a uniform time grid at this frequency (kept
+        # in self.upsampled_data and written to _merged_pupil_upsampled.csv)
+        # rather than on the time stamps of the samples:
+
+        interp_settings['upsampled_output'] = False
+
         # ----------------------------------------------------------------------
         # Calculate the low pass filter specs using the cutoff frequency [Hz],
         # filter order, and the upsample frequency specified above:
@@ -522,6 +1560,10 @@ class pypil(object):
             interp_settings['lp_filt_A'] = signal.butter(interp_settings['lp_filt_order'],
                                                          2 * interp_settings['lp_filt_cutoff_freq'] /
                                                          interp_settings['interp_upsampling_freq'])
+        # the same filter as second-order sections (numerically safer, used by the 'segments' smoothing mode)
+        interp_settings['lp_filt_sos'] = signal.butter(interp_settings['lp_filt_order'],
+                                                       2 * interp_settings['lp_filt_cutoff_freq'] /
+                                                       interp_settings['interp_upsampling_freq'], output='sos')
 
         # Maximum gap [ms] in the used raw samples to interpolate over
         # (section that were interpolated over larger distances will be
@@ -529,367 +1571,218 @@ class pypil(object):
         interp_settings['interp_max_gap'] = 250
 
         # ----------------------------------------------------------------------
+        # Smoothing mode: 'session' interpolates over all gaps and low pass
+        # filters the whole session in one go; 'segments' splits the session
+        # wherever the valid samples are more than segment_min_gap [ms] apart
+        # (recording pauses, long blinks) and, if split_blocks, wherever the
+        # block changes, and filters each segment on its own (with
+        # lp_filt_sos, over smoothing_workers threads; None for all cores).
+        # Samples between segments are set to missing:
+
+        interp_settings['smoothing_mode'] = 'session'
+        interp_settings['segment_min_gap'] = interp_settings['interp_max_gap']
+        interp_settings['split_blocks'] = True
+        interp_settings['smoothing_workers'] = None
 
-        self.interp_settings = interp_settings
-
-    def _remove_out_of_bounds(self):
-        min_val = self.filter_settings['pupil_diameter_min']
-        max_val = self.filter_settings['pupil_diameter_max']
-
-        assert (min_val < max_val
-                ), "The maximum pupil diameter must be larger than the minimum"
-
-        self.merged_data.is_valid = self.merged_data.is_valid & self.merged_data.inter_pupil.between(min_val, max_val)
-        # Haoxue q: why put this as self.valid_time, not in merged_data? (though this has been used in later part of the code)
-        self.valid_time = self.merged_data.time[self.merged_data.is_valid]
-
-        # assert (min_val < max_val
-        #         ), 'Time series must be strictly increasing'
+        # ----------------------------------------------------------------------
 
-        self._remove_loners()
+        self.interp_settings = interp_settings
 
-    def _remove_loners(self, do_plots=False, change_is_valid=True):
+    def _interp_and_smooth(self):
         '''
-        Identify island that are separated in time from other samples by at least
-        self.filter_settings['island_filter_seperation_ms'] and is less than
-        self.filter_settings['island_filter_island_width_ms'] long.
-
-        It will update the self.merged_data.is_valid Series to mark those islands as invalid.
+        Interpolates and smooths pupil data, with up sampling value rate specified in self.filter_settings.
+        If self.interp_settings['upsampled_output'], the pupil is smoothed on a uniform time grid at
+        interp_upsampling_freq (kept in self.upsampled_data) and mapped back to the samples from there.
         '''
-
-        # These were labeled backwards in Kret & Sjak-Shie (2018). Correct logic but mis-informative naming scheme.
-        min_sep = self.filter_settings['island_filter_seperation_ms']
-        max_island_width = self.filter_settings['island_filter_island_width_ms']
-
-        # Written differently from Kret & Sjak-Shie (2018) because pandas.diff produces NaN in beginning
-        shore_left = self.valid_time.diff().fillna(np.Inf) > min_sep
-        shore_right = self.valid_time.diff(-1).fillna(-np.Inf) < -min_sep
-
-        island_binz = np.array([self.valid_time[shore_left].sub(.001),
-                                self.valid_time[shore_right].add(.001)]).flatten('F')
-        island_numb = pd.Series(np.digitize(self.valid_time, island_binz),
-                                index=self.valid_time.index, name='island_numb')
-
-        # The index [0] is because we just want the array not the full object
-        tiny_islands = np.where(np.diff(island_binz) - .002 < max_island_width)[0]
-
-        # if change_is_valid=True, we are going to change is_valid in the df
-        # if not, we are going to give a new one-time column to store it temporarily
-        if change_is_valid:
-            self.merged_data.is_valid = ~island_numb.isin(tiny_islands) & self.merged_data.is_valid
-            self.merged_data['valid_time'] = np.where(self.merged_data.is_valid, self.merged_data.time, np.NaN)
+        time = self.merged_data.time.to_numpy()
+        self.upsampled_data = None
+        if self.interp_settings.get('upsampled_output', False):
+            # time_upsampled = np.arange(self.merged_data.time.iloc[0], self.merged_data.time.iloc[-1], 4)
+            step_ms = 1000 / self.interp_settings['interp_upsampling_freq']
+            time_upsampled = np.arange(time[0], time[-1] + step_ms / 2, step_ms)
+            smoothed_upsampled = self._smooth(time_upsampled)
+            smoothed_upsampled[self._gaps_ms(time_upsampled) > self.interp_settings['interp_max_gap']] = np.NaN
+            self.upsampled_data = pd.DataFrame({'time': time_upsampled,
+                                                'smoothed_interp_pupil': smoothed_upsampled.astype(np.float32)})
+            smoothed = np.interp(time, time_upsampled, smoothed_upsampled)
         else:
-            self.merged_data['is_valid_tmp'] = ~island_numb.isin(tiny_islands) & self.merged_data.is_valid
-        if do_plots:
-            ''' Plot the time series and highlight the invalid options and all that jazz. '''
-            pass
-
-    def _mad_speed_filter(self):
-        '''
-        Filters a diameter timeseries based on the dilation speeds.
-        '''
-        max_gap_distance = self.filter_settings['dialation_speed_filter_max_gap_ms']
-        valid_pupil = self.merged_data.pupil[self.merged_data.is_valid]
-        valid_time = self.merged_data.time[self.merged_data.is_valid]
-        max_dilation_speeds = []  # I am going to want to make this a pd Series to match up indexes later
-
-        # Calculate dilation speed (displacement / time)
-        dilation_speeds = valid_pupil.diff().div(valid_time.diff())
-
-        dilation_speeds[valid_time.diff() > max_gap_distance] = np.NaN
-
-        back_fwd_dilations = pd.concat([dilation_speeds.diff().rename(
-            'for'), dilation_speeds.diff(-1).rename('back')], axis=1)
-        max_dilation_speeds = back_fwd_dilations.abs().max(1)
-
-        # Calculate threshold and mark the outliers
-        mad, thresh = self._mad_calc(max_dilation_speeds)
-        self.merged_data.is_valid = self.merged_data.is_valid & (max_dilation_speeds <= thresh)
-
-        # Update Valid time and remove any remaining islands:
-        self.valid_time = self.merged_data.time[self.merged_data.is_valid]
-        self._remove_loners()  #
-        '''I want to update all the functions to have the first thing they do is get valid_time
-        from the merged dataset'''
-
-        # Blinks and other artifact with large inter-sample differences may
-        # distort the signal surrounding samples that do not exceed the filter
-        # criteria. As such, remove samples surrounding gaps of a certain size:
-        self._expand_gaps()
-
-        # Set output:
-        self.filter_settings['max_dilation_speeds'] = max_dilation_speeds
-        self.filter_settings['is_valid'] = self.merged_data.is_valid
-        self.filter_settings['mad'] = mad
-        self.filter_settings['med_d'] = max_dilation_speeds.median()
-        self.filter_settings['thresh'] = thresh
-
-    def _mad_calc(self, series):
-        '''
-        Calculates and Returns the Median Absolute Deviation and thresholds based on filter settings
-        and equation described in Kret & Sjak-Shie (2018).
-        '''
-        mad_multiplier = self.filter_settings['dialation_speed_filter_MAD_multiplier']
-        mad = series.sub(series.median()).abs().median()
-        # Haoxue: this following row is Deshawn's original and is INCORRECT.
-        # thresh = series.median() + (mad_multiplier * series.mad())
-        thresh = series.median() + (mad_multiplier * mad)
-
-        return(mad, thresh)
-
-    def _expand_gaps(self):
-        '''
-        Remove samples around gaps, see default settings for details.
-        '''
-
-        # Get Settings:
-        min_gap = self.filter_settings['gap_min_width']
-        max_gap = self.filter_settings['gap_max_width']
-        back_pad = self.filter_settings['gap_padding_backward']
-        fwd_pad = self.filter_settings['gap_padding_forward']
-
-        # Blinks produce gaps in the data, the edges of these gaps may contain
-        # additional artifacts, as such we will expand on these edges
-        valid_time = self.merged_data.time[self.merged_data.is_valid]
-
-        # Calculate the duration of each gap, and test whether it exceeds the threshold
-
-        if min_gap and max_gap:
-            gaps_s = valid_time.diff(-1).abs()
-            gaps_e = valid_time.diff()
-            needs_padding_s = gaps_s.gt(min_gap) & gaps_s.lt(max_gap)
-            needs_padding_e = gaps_e.gt(min_gap) & gaps_e.lt(max_gap)
-
-            # Get the start and end time of each gap
-            gap_starts = valid_time[needs_padding_s]
-            gap_ends = valid_time[needs_padding_e]
-
-            if back_pad > 0 and fwd_pad > 0:
-
-                # Detect samples around the gaps
-                near_gap = pd.concat([valid_time.gt(gap_starts - back_pad),
-                                      valid_time.lt(gap_ends + fwd_pad)], axis=1).any(axis=1)
+            smoothed = self._smooth(time)
 
-                # Reject samples too near a gap
-                self.merged_data.is_valid = self.merged_data.is_valid & ~near_gap
+        # Remove smoothed pupil data points based on the calculated gaps
+        smoothed[self._gaps_ms(time) > self.interp_settings['interp_max_gap']] = np.NaN
+        self.merged_data['smoothed_interp_pupil'] = smoothed
 
-    def _mad_deviation_filter(self):
-        '''
-        Filters pupil diameter timeseries based on the deviation fromt a smooth trendline.
+        # The division was removed according to the pupil analysis techniques illustrated by Dave and Linda. 
+        self.merged_data['smoothed_interp_pupil_corrected'] = self.merged_data.smoothed_interp_pupil  # / self.merged_data.smoothed_interp_pupil.mean()
+        self.merged_data['inter_pupil_corrected'] = self.merged_data.inter_pupil  # / self.merged_data.inter_pupil.mean()
+        self.include_pupil = True
 
-        Currently does not support upsampling. Interpolation will occur at the same time scale
-        of the self.merged_data.time pandas.Series.
+    def _smooth(self, times):
         '''
-        # [isValid_Running,filtData] = madDeviationFilter(t_ms,dia,isValid_In,filtSettings)
-
-        # % madDeviationFilter filters a diameter timeseries based on the deviation
-        # % from a smooth trendline.
-        # %
-        # %--------------------------------------------------------------------------
-
-        # Get Relevant Settings
-        n_passes = self.filter_settings['residuals_filter_passes']
-
-        # If an when I incorporate upsampling this is were it will occur.
-        # time_interp = np.arange(self.merged_data.time.iloc[0], self.merged_data.time.iloc[-1],
-        #                         (1000 / self.filter_settings['residuals_filter_interpFs']))
-
-        assert (self.merged_data.is_valid.sum() > 3  # Arbitrary got from Kret & Sjak-Shie (2018)
-                ), "There needs to be greater than 3 valid time points to interpolate."
-
-        self.smoothed_per_pass = pd.DataFrame(columns=['{}{}'.format(y, x) for x in range(n_passes)
-                                                       for y in ['resid', 'smooth', 'is_valid']],
-                                              index=self.merged_data.time.index)
-        is_valid_loop = self.merged_data.is_valid
-        is_done = False
-        for pass_ind in range(n_passes):
-
-            # If the last filter did not have any effect, neither will any of the others
-            if is_done:
-                break
-
-            # Tracking Valid trials
-            is_valid_start = is_valid_loop
-
-            # Calculate and Smooth baseline and deviation
-            self._deviation_calc(pass_ind)
-
-            # Calculate MAD stats
-            _, thresh = self._mad_calc(self.smoothed_per_pass['resid{}'.format(pass_ind)])
-
-            # Remove outliers and remove isolated rejection filter
-            is_valid_loop = (self.smoothed_per_pass['resid{}'.format(pass_ind)] <= thresh) & self.merged_data.is_valid
-            self.valid_time = self.merged_data.time[is_valid_loop]
-            self._remove_loners()
-            is_valid_loop = self.merged_data.is_valid
-
-            # Log loop vars
-            self.smoothed_per_pass['is_valid{}'.format(pass_ind)] = is_valid_loop
-
-            # Determine if this filter step had an effect
-            if pass_ind and all(is_valid_start == is_valid_loop):  # Can't be first pass e.g., pass_ind = 0
-                # Copy the current results to the other columns
-                for ind in range(pass_ind + 1, n_passes):
-                    self.smoothed_per_pass['is_valid{}'.format(ind)] = self.smoothed_per_pass['is_valid{}'.format(ind - 1)]
-                    self.smoothed_per_pass['smooth{}'.format(ind)] = self.smoothed_per_pass['smooth{}'.format(ind - 1)]
-                    self.smoothed_per_pass['resid{}'.format(ind)] = self.smoothed_per_pass['resid{}'.format(ind - 1)]
-
-                is_done = True
-    
-    def _mad_deviation_filter2(self):
+        Interpolates the valid samples at times and low pass filters them (per segment in the 'segments' smoothing mode)
         '''
-        Test out the part that differs
-        Filters pupil diameter timeseries based on the deviation fromt a smooth trendline.
+        if self.interp_settings.get('smoothing_mode', 'session') == 'segments':
+            return self._smooth_segments(times)
 
-        Currently does not support upsampling. Interpolation will occur at the same time scale
-        of the self.merged_data.time pandas.Series.
-        '''
-        # [isValid_Running,filtData] = madDeviationFilter(t_ms,dia,isValid_In,filtSettings)
-
-        # % madDeviationFilter filters a diameter timeseries based on the deviation
-        # % from a smooth trendline.
-        # %
-        # %--------------------------------------------------------------------------
-
-        # Get Relevant Settings
-        n_passes = self.filter_settings['residuals_filter_passes']
-
-        # If an when I incorporate upsampling this is were it will occur.
-        # time_interp = np.arange(self.merged_data.time.iloc[0], self.merged_data.time.iloc[-1],
-        #                         (1000 / self.filter_settings['residuals_filter_interpFs']))
-
-        assert (self.merged_data.is_valid.sum() > 3  # Arbitrary got from Kret & Sjak-Shie (2018)
-                ), "There needs to be greater than 3 valid time points to interpolate."
-
-        self.smoothed_per_pass = pd.DataFrame(columns=['{}{}'.format(y, x) for x in range(n_passes)
-                                                       for y in ['resid', 'smooth', 'is_valid']],
-                                              index=self.merged_data.time.index)
-        is_valid_loop = self.merged_data.is_valid.copy(deep=True)
-        is_valid_init = self.merged_data.is_valid.copy(deep=True)
-        is_done = False
-        for pass_ind in range(n_passes):
-
-            # If the last filter did not have any effect, neither will any of the others
-            if is_done:
-                break
-
-            # Tracking Valid trials
-            is_valid_start = is_valid_loop.copy(deep=True)
-
-            # Calculate and Smooth baseline and deviation
-            self._deviation_calc(pass_ind)
-
-            # Calculate MAD stats
-            _, thresh = self._mad_calc(self.smoothed_per_pass['resid{}'.format(pass_ind)])
-
-            # Remove outliers and remove isolated rejection filter
-            is_valid_loop_test = (self.smoothed_per_pass['resid{}'.format(pass_ind)] <= thresh) & self.merged_data.is_valid
-            is_valid_loop = (self.smoothed_per_pass['resid{}'.format(pass_ind)] <= thresh) & is_valid_init
-            # if all(is_valid_loop_test == is_valid_loop):
-            #     print('is_valid_loop_test == is_valid_loop, curr_idx: ', pass_ind)
-            self.valid_time = self.merged_data.time[is_valid_loop]
-            # this is the function where the valid index get to be changed
-            # (need to check again whether this is the case in the matlab dataset)
-            self._remove_loners()
-            is_valid_loop = self.merged_data.is_valid.copy(deep=True)
-
-            # Log loop vars
-            self.smoothed_per_pass['is_valid{}'.format(pass_ind)] = is_valid_loop.copy(deep=True)
-
-            # Determine if this filter step had an effect
-            if pass_ind and all(is_valid_start == is_valid_loop):  # Can't be first pass e.g., pass_ind = 0
-                print('pass_ind:', pass_ind)
-                # Copy the current results to the other columns
-                for ind in range(pass_ind + 1, n_passes):
-                    self.smoothed_per_pass['is_valid{}'.format(ind)] = self.smoothed_per_pass['is_valid{}'.format(ind - 1)]
-                    self.smoothed_per_pass['smooth{}'.format(ind)] = self.smoothed_per_pass['smooth{}'.format(ind - 1)]
-                    self.smoothed_per_pass['resid{}'.format(ind)] = self.smoothed_per_pass['resid{}'.format(ind - 1)]
-
-                is_done = True
-    
-    def _deviation_calc(self, pass_index, interp_time=None):
-        '''
-        Calculating the deviation metrics ported from Kret & Sjak-Shie (2018)
-        '''
-
-        if not interp_time:
-            interp_time = self.merged_data.time
-
-        # assert ()
-        valid_pupil = self.merged_data.pupil[self.merged_data.is_valid]
-        valid_time = self.merged_data.time[self.merged_data.is_valid]
-        smooth_filtA = self.filter_settings['residuals_filter_lowpassA']
-        smooth_filtB = self.filter_settings['residuals_filter_lowpassB']
-
-        # Generate a smooth signal using linear interpolation, and nearest neighbor
-        # extrapolation. Use only the currently available samples.
-        # By default numpy (unlike MATLAB) does nearest neighbor for extrapolation
-        interp_pupil = np.interp(interp_time, valid_time, valid_pupil)
-
-        # Low pass filter the uniform signal and map it back to the original timeseries
-        smooth_pupil = signal.filtfilt(smooth_filtB, smooth_filtA, interp_pupil)
-        smooth_interp_pupil = np.interp(interp_time, self.merged_data.time, smooth_pupil)
-
-        # Calculated the absolute deviation
-        dev = abs(self.merged_data.pupil - smooth_interp_pupil)
+        inter_pupil = np.interp(times,
+                                self.merged_data.time[self.merged_data.is_valid],
+                                self.merged_data.inter_pupil[self.merged_data.is_valid])
 
-        # Store them in the class variables.
-        self.smoothed_per_pass['smooth{}'.format(pass_index)] = smooth_interp_pupil
-        self.smoothed_per_pass['resid{}'.format(pass_index)] = dev
+        # NEED TO CHECK THIS. Specifically compare to MATLABS filter
+        return signal.filtfilt(self.interp_settings['lp_filt_B'], self.interp_settings['lp_filt_A'], inter_pupil)
 
-    def _interp_and_smooth(self, for_baseline=False):
+    def _gaps_ms(self, times):
         '''
-        Interpolates and smooths pupil data, with up sampling value rate specified in self.filter_settings.
+        Returns, for each of times, the width [ms] of the gap between the valid samples it is interpolated from
+        (the distance to the nearest valid sample when it is extrapolated, and 0 when it is within half an
+        upsampling interval h of a valid sample, i.e. in [valid - h, valid + h)). Found with one binary search of
+        times in the valid time stamps. Note that the pandas version took the gap after the next valid sample,
+        so times in long gaps next to short ones were not set to missing as they are now.
         '''
-        
-
-        # time_upsampled = np.arange(self.merged_data.time.iloc[0], self.merged_data.time.iloc[-1], 4)
-        # np.interp(time_upsampled, self.merged_data.time, self.merged_data.inter_pupil)
-        inter_pupil = np.interp(self.merged_data.time,
-                                self.merged_data.time[self.merged_data.is_valid],
-                                self.merged_data.pupil[self.merged_data.is_valid])
-
-        # NEED TO CHECK THIS. Specifically compare to MATLABS filter
-        self.merged_data['smoothed_interp_pupil'] = signal.filtfilt(self.interp_settings['lp_filt_B'],
-                                                             self.interp_settings['lp_filt_A'],
-                                                             inter_pupil)
-
-        # Calculate the gaps (the edges don't really matter, samples
-        # close to the edges will be given a gap of 0 subsequently).
-        valz = self.merged_data.time[self.merged_data.is_valid].diff(-1).abs()
-        valz.iloc[-1] = valz.iloc[-2]  # Replace the NaN with the previous gap value
-        binz = np.digitize(self.merged_data.time, self.merged_data.time[self.merged_data.is_valid], right=True)
-        binz = np.where(binz == len(valz), len(valz) - 1, binz)  # Make sure that the binz are inside the bounds of the pd.Series
-        # gaps_ms = valz.as_matrix()[binz] # as_matrix method is deprecated since 0.23.0
-        gaps_ms = valz.to_numpy()[binz]
+        valid_time = self.merged_data.time.to_numpy()[self.merged_data.is_valid.to_numpy(dtype=bool)].astype(float)
+        times = np.asarray(times, dtype=float)
+
+        # the valid samples right before (or at) and right after each of times (clipped at the first and last one)
+        pos = np.searchsorted(valid_time, times, side='right')
+        prev_dist = times - valid_time[np.maximum(pos - 1, 0)]
+        next_dist = valid_time[np.minimum(pos, len(valid_time) - 1)] - times
+        # within the valid samples the gap is the sum of both distances; before the first (after the last)
+        # valid sample it is only the distance to that sample
+        prev_dist[pos == 0] = 0
+        next_dist[pos == len(valid_time)] = 0
+        gaps_ms = prev_dist + next_dist
 
         # Set samples that are really close to the raw samples as
         # having no gap (scale the closeness with the sampling freq.).
         # In this case it is set to half the sampling interval:
         not_touching_you_ms = .5 * 1000 / self.interp_settings['interp_upsampling_freq'] # question: is this the original sampling frequency, or is this the sampling frequency that has already been reduced?
+        gaps_ms[(pos > 0) & (prev_dist < not_touching_you_ms)] = 0
+        gaps_ms[(pos < len(valid_time)) & (next_dist <= not_touching_you_ms)] = 0
+        return gaps_ms
 
-        # Haoxue: this part is a little hard to understand
-        binz = self.merged_data.time[self.merged_data.is_valid].to_numpy()[:, None] + np.array([-1, 1]) * not_touching_you_ms
-        binz_hits = np.digitize(self.merged_data.time, binz.flatten())
-        almost_touching = np.mod(binz_hits, 2) == 1
-
-        # Now actually set the upsampled timestamps that are really
-        # close to the timestamps of the valid measured data points to
-        # zero
-        gaps_ms[almost_touching] = 0
+    def _smooth_segments(self, times):
+        '''
+        Interpolates the valid samples at times and zero-phase low pass filters (signal.sosfiltfilt) every segment on
+        its own, see the 'segments' smoothing mode in default_interp_settings. Returns the smoothed pupil as an array
+        (NaN between segments).
+        '''
+        is_valid = self.merged_data.is_valid.to_numpy(dtype=bool)
+        valid_time = self.merged_data.time.to_numpy()[is_valid]
+        valid_pupil = self.merged_data.inter_pupil.to_numpy(dtype=float)[is_valid]
+        sos = self.interp_settings['lp_filt_sos']
+
+        # segment breaks, as indices into the valid samples
+        new_segment = np.diff(valid_time) > self.interp_settings['segment_min_gap']
+        if self.interp_settings['split_blocks'] and 'block' in self.merged_data.columns:
+            block = self.merged_data.block.ffill().fillna(-1).to_numpy(dtype=float)[is_valid]
+            new_segment |= np.diff(block) != 0
+        breaks = np.flatnonzero(new_segment) + 1
+        starts, stops = np.r_[0, breaks], np.r_[breaks, len(valid_time)]
+
+        # every segment runs from its first to its last valid sample (the first and last segment up to the
+        # edges of the session, where the pupil is extrapolated as in the 'session' mode)
+        lo = np.searchsorted(times, valid_time[starts])
+        hi = np.searchsorted(times, valid_time[stops - 1], side='right')
+        lo[0], hi[-1] = 0, len(times)
+
+        smoothed = np.full(len(times), np.nan)
+
+        def smooth_segment(k):
+            segment = np.interp(times[lo[k]:hi[k]], valid_time[starts[k]:stops[k]], valid_pupil[starts[k]:stops[k]])
+            if len(segment) > 1:
+                # shorter segments than the default padding are padded by as much as they allow
+                segment = signal.sosfiltfilt(sos, segment, padlen=min(3 * (2 * len(sos) + 1), len(segment) - 1))
+            smoothed[lo[k]:hi[k]] = segment
+
+        # sosfiltfilt releases the GIL, so the segments can be filtered by threads of this process
+        with ThreadPoolExecutor(max_workers=self.interp_settings['smoothing_workers']) as pool:
+            list(pool.map(smooth_segment, range(len(starts))))
+        return smoothed
+
+    def write_processed(self, for_baseline=False):
+        '''
+        write the processed data to _merged_pupil.csv (or _merged_pupil_baseline.csv; the upsampled data, if any, to
+        _merged_pupil[_baseline]_upsampled.csv), unless that file already holds the output of the current process
+        stage (the key of the stage that wrote it is kept next to the stage cache)
+        '''
+        if for_baseline:
+            file_name = os.path.join(self.data_dir, '{}_merged_pupil_baseline.csv'.format(self.subjectid)) # technically speaking there is no real merge happening..
+        else:
+            file_name = os.path.join(self.data_dir, '{}_merged_pupil.csv'.format(self.subjectid))
+        key_file = os.path.join(self.cache_dir, 'stages', os.path.basename(file_name) + '.key')
+        try:
+            with open(key_file, 'r') as f:
+                up_to_date = os.path.exists(file_name) and f.read() == self.process_key
+        except OSError:
+            up_to_date = False
+        if up_to_date and not self.overwrite:
+            return
+
+        self._csv_ready(self.merged_data).to_csv(file_name, index=False)
+        if getattr(self, 'upsampled_data', None) is not None:
+            self._csv_ready(self.upsampled_data).to_csv(file_name.replace('.csv', '_upsampled.csv'), index=False)
+        with open(key_file, 'w') as f:
+            f.write(self.process_key)
+
+    def process_in_blocks(self, overwrite=False):
+        '''
+        Out-of-core version of prepare_phase, filter_phase and process_valid_samples for very long recordings (or
+        high sampling rates). The ASC file is read block by block (see _read_task_blocks) and every block is merged
+        with its messages, downsampled, filtered, interpolated and smoothed on its own, together with
+        self.block_margin_ms of the neighbouring blocks so the filters see the same context at its edges. Only the
+        samples a block owns are appended to _merged_pupil.csv, so memory is bounded by the longest block rather
+        than by the session. The intermediate csv files and the caches of the phases are not written.
+
+        Differences with the whole-session phases: the MAD thresholds of the filters (and the mean difference between
+        the eyes of binocular recordings, see mean_pupil) are computed per block, and samples between the last
+        message of a block and the first one of the next are not labelled with the last trial of the block.
+
+        At the end self.baseline_pupil_data holds the downsampled baseline (as after prepare_phase), the task data
+        are only kept in the csv file.
+        '''
+        if os.path.splitext(self.filename)[1].lower() == '.edf':
+            raise Exception('process_in_blocks needs the ASC file of {}.'.format(self.subjectid))
+        try:
+            self.filter_settings
+        except Exception:
+            self.default_filter_settings()
+        try:
+            self.interp_settings
+        except Exception:
+            self.default_interp_settings()
+        self.overwrite = bool(overwrite)
 
-        # Remove smoothed pupil data points based on the calculated gaps
-        self.merged_data.smoothed_interp_pupil.iloc[gaps_ms > self.interp_settings['interp_max_gap']] = np.NaN
+        file_name = os.path.join(self.data_dir, '{}_merged_pupil.csv'.format(self.subjectid))
+        if os.path.exists(file_name) and not self.overwrite:
+            print('{} data EXISTED'.format(self.subjectid))
+            return
 
-        # The division was removed according to the pupil analysis techniques illustrated by Dave and Linda. 
-        self.merged_data['smoothed_interp_pupil_corrected'] = self.merged_data.smoothed_interp_pupil  # / self.merged_data.smoothed_interp_pupil.mean()
-        self.merged_data['inter_pupil_corrected'] = self.merged_data.inter_pupil  # / self.merged_data.inter_pupil.mean()
-        self.include_pupil = True
+        write_raw_csv = self.write_raw_csv
+        self.write_raw_csv = False
+        for data_name in ['pupil_data', 'merged_data', 'baseline_pupil_data']:
+            if hasattr(self, data_name):
+                delattr(self, data_name)
+        try:
+            for block_idx, (pupil_data, messages, (own_start, own_end)) in enumerate(self._read_task_blocks()):
+                self.pupil_data = pupil_data
+                self.message_data = self._parse_messages(messages)
+                self.mess_pupil_merge2()
+                self.down_sample()
+                self._filter()
+                self._interp_and_smooth()
+                own = (self.merged_data.time >= own_start) & (self.merged_data.time < own_end)
+                self._csv_ready(self.merged_data[own]).to_csv(file_name, index=False, mode='a' if block_idx else 'w', header=not block_idx)
+            del self.pupil_data, self.merged_data
+        finally:
+            self.write_raw_csv = write_raw_csv
 
-        if for_baseline:
-            self.merged_data.to_csv(os.path.join(self.data_dir, '{}_merged_pupil_baseline.csv'.format(self.subjectid)), index=False) # technically speaking there is no real merge happening..
+        if overwrite:
+            print('{} data were OVERWRITTEN'.format(self.subjectid))
         else:
-            self.merged_data.to_csv(os.path.join(self.data_dir, '{}_merged_pupil.csv'.format(self.subjectid)), index=False)
+            print('{} data were CREATED'.format(self.subjectid))
+        self.organize_baseline()
+        if self.contain_baseline:
+            self.down_sample()
 
 # functions below are advanced preprocessing and should be run after prepare_phase - filter - interp_smooth
     def read_merged_and_task(self, task_df_name=None, overwrite=False):
@@ -897,8 +1790,7 @@ class pypil(object):
         read preprocessed pupil data and task df (separately)
         also read in merged_pupil_first_row if it exists
         '''
-        if overwrite:
-            self.overwrite = overwrite
+        self.overwrite = bool(overwrite)
         # read in merged pupil first if exists
         if (not os.path.exists(os.path.join(self.data_dir, '{}_merged_pupil_first_row_AFTER.csv'.format(self.subjectid))) or self.overwrite):
             if overwrite:
@@ -906,11 +1798,11 @@ class pypil(object):
             else:
                 print('{} [merged pupil first row] data was CREATED'.format(self.subjectid))
         else:
-            self.merged_data_first_row = pd.read_csv(os.path.exists(os.path.join(self.data_dir, '{}_merged_pupil_first_row_AFTER.csv'.format(self.subjectid))))
+            self.merged_data_first_row = pd.read_csv(os.path.join(self.data_dir, '{}_merged_pupil_first_row_AFTER.csv'.format(self.subjectid)))
         
         # read in merged data
         try:
-            self.merged_data = pd.read_csv(os.path.join(self.data_dir, '{}_merged_pupil.csv'.format(self.subjectid)))
+            self.merged_data = self._compact(pd.read_csv(os.path.join(self.data_dir, '{}_merged_pupil.csv'.format(self.subjectid))))
         except:
             raise Exception('There is no merged pupil file.')
 
@@ -928,10 +1820,11 @@ class pypil(object):
         use merged_pupil.csv to generate a datafile with one row for each trial
         the function is called after irrelevant columns and events are removed
         '''
-        if (not 'identifier' in self.merged_data.columns) or (not 'identifier' in self.task_df.columns):
+        if (not 'trial_key' in self.merged_data.columns) or (not 'trial_key' in self.task_df.columns):
             self.add_identifier()
-        self.merged_data_first_row = self.merged_data.groupby(['identifier']).head(1).\
-            merge(self.task_df, on=['ID','block','trial','identifier'], how='outer')
+        self.merged_data_first_row = self.merged_data.groupby(['trial_key']).head(1).\
+            merge(self.task_df.drop(columns='identifier'), on=['ID','block','trial','trial_key'], how='outer')
+        self._add_identifier_labels(self.merged_data_first_row)
         self.drop_redundant_column(for_first_row=True)
             
     def remove_irrelevant_events(self):
@@ -947,41 +1840,59 @@ class pypil(object):
         if not for_first_row:
             self.merged_data.drop(columns=self.redundant_col, inplace=True)
         else:
-            self.merged_data_first_row.drop(columns=self.redundant_col_first_row, inplace=True)
+            self.merged_data_first_row.drop(columns=self.redundant_col_first_row, inplace=True, errors='ignore')
 
     def add_identifier(self):
         '''
-        add unique subjectID-block-trial identifier to both merged data and task to facilitate future mapping
-        before adding identifier, make sure the data type are the same across two df
+        add an integer subject-level trial key (block * self.trial_key_base + trial, -1 outside of trials) to both
+        merged data and task to facilitate future mapping, and the subjectID-block-trial identifier string to task.
+        before adding the key, make sure the data type are the same across two df
         '''
-        self.merged_data['ID'] = self.merged_data['ID'].astype(str)
-        self.merged_data['block'] = self.merged_data['block'].astype(float)
-        self.merged_data['trial'] = self.merged_data['trial'].astype(float)
         self.task_df['ID'] = self.task_df['ID'].astype(str)
-        self.task_df['block'] = self.task_df['block'].astype(float)
-        self.task_df['trial'] = self.task_df['trial'].astype(float)
-
-        if not 'identifier' in self.merged_data.columns:
-            self.merged_data['identifier'] = self.merged_data['ID'] + self.merged_data['block'].astype(str) + self.merged_data['trial'].astype(str)
+        for df in [self.merged_data, self.task_df]:
+            self._compact(df)
+            if not 'trial_key' in df.columns:
+                trial_key = df['block'].astype('Int32') * self.trial_key_base + df['trial'].astype('Int32')
+                df['trial_key'] = trial_key.fillna(-1).astype(np.int32)
 
         if not 'identifier' in self.task_df.columns:
-            self.task_df['identifier'] = self.task_df['ID'] + self.task_df['block'].astype(str) + self.task_df['trial'].astype(str)
+            self._add_identifier_labels(self.task_df)
+
+    def _add_identifier_labels(self, df):
+        '''
+        add the subjectID-block-trial identifier string (e.g. 'S011.02.0', as used by the R scripts) to df as a
+        categorical column, formatting each trial_key only once
+        '''
+        codes, keys = pd.factorize(df['trial_key'])
+        first_rows = df.iloc[np.unique(codes, return_index=True)[1]]
+        labels = first_rows['ID'].astype(str) + first_rows['block'].astype(float).astype(str) + \
+            first_rows['trial'].astype(float).astype(str)
+        df['identifier'] = pd.Categorical.from_codes(codes, categories=labels.to_numpy())
 
     def add_timestamp(self):
         '''
-        calculate timestamp based on column event for each trial
+        calculate timestamp based on column event for each trial: for every event, the time relative to the first
+        sample of that event in the same trial (NaN in trials without that event). The onsets of all (trial, event)
+        pairs are found with a single groupby and broadcast back to the samples through the trial codes.
         '''
-        def df_add_timestamp(df):
-            first_row = df.groupby('event').head(1)
-            list_time_step = [df.time - x for x in first_row.time]
-            for i in range(len(list_time_step)):
-                col_name = 'timestamp_locked_at_' + first_row.event.iloc[i]
-                df.loc[:,col_name] = list_time_step[i]
-            return df
-        if not 'identifier' in self.merged_data.columns:
+        if not 'trial_key' in self.merged_data.columns:
             self.add_identifier()
-        self.merged_data = self.merged_data.groupby('identifier').apply(df_add_timestamp) 
-       
+        onsets = self.merged_data.groupby(['trial_key', 'event'], observed=True, sort=False)['time'].first()
+        # columns in the order the events first occur when going through the trials
+        events = onsets.index.to_frame(index=False).sort_values('trial_key', kind='stable')['event'].unique()
+        codes, keys = pd.factorize(self.merged_data['trial_key'])
+        onsets = onsets.unstack('event').reindex(index=keys, columns=events)
+
+        time = self.merged_data['time'].to_numpy()
+        timestamps = {}
+        for event in events:
+            timestamp = time - onsets[event].to_numpy()[codes]
+            if not np.isnan(timestamp).any():
+                # keep the dtype of time when the event occurs in every trial
+                timestamp = timestamp.astype(time.dtype)
+            timestamps['timestamp_locked_at_' + str(event)] = timestamp
+        self.merged_data = pd.concat([self.merged_data, pd.DataFrame(timestamps, index=self.merged_data.index)], axis=1)
+
     def avg_within_timewindow(self, \
         timestamp_col='timestamp_locked_at_stimulus_pre_with_fixation_onset',\
         y_col='remove_baseline_smoothed_interp_pupil_corrected',\
@@ -989,38 +1900,80 @@ class pypil(object):
         new_x_col='avg'):
         '''
         calculate y_col avg within timestamp_range for timestamp_col
+        (a single window of avg_within_timewindows)
         '''
+        self.avg_within_timewindows([(timestamp_col, timestamp_range, y_col, new_x_col)])
 
-        def df_avg_within_timewindow(df, \
-        timestamp_col='timestamp_locked_at_stimulus_pre_with_fixation_onset',\
-        y_col='remove_baseline_smoothed_interp_pupil_corrected',\
-        timestamp_range=[-1000, 0]):
-            '''
-            function inside apply to calculate avg within a timewindow
-            '''
-            output = df.loc[(df[timestamp_col] >= timestamp_range[0]) & (df[timestamp_col] <= timestamp_range[1]), y_col].mean()
-            return output 
-
-        if not 'identifier' in self.merged_data.columns:
+    def avg_within_timewindows(self, windows):
+        '''
+        calculate the avg of several time windows for every trial in one pass and add them to merged_data_first_row
+        windows is a list of (lock event, timestamp_range, y_col, new_x_col), e.g.
+        ('stimulus_pre_with_fixation_onset', [500, 2500], 'remove_baseline_smoothed_interp_pupil_corrected', 'eval_middle_2000')
+        the lock event can also be given as its timestamp column (timestamp_locked_at_...)
+        both ends of timestamp_range are included; trials without samples in a window get NaN
+        '''
+        if not 'trial_key' in self.merged_data.columns:
             self.add_identifier()
-        output = self.merged_data.groupby(['identifier']).\
-            apply(df_avg_within_timewindow, \
-                timestamp_col=timestamp_col, y_col=y_col, \
-                    timestamp_range=timestamp_range)
-        output = output.reset_index().rename(columns={0:new_x_col})
-        self.merged_data_first_row = self.merged_data_first_row.merge(output, on='identifier')
+        # y_col within each window (NaN outside of it), so that a single groupby averages all windows
+        windowed = {}
+        for lock_event, timestamp_range, y_col, new_x_col in windows:
+            timestamp_col = lock_event if lock_event in self.merged_data.columns else 'timestamp_locked_at_' + lock_event
+            timestamp = self.merged_data[timestamp_col]
+            in_window = (timestamp >= timestamp_range[0]) & (timestamp <= timestamp_range[1])
+            windowed[new_x_col] = self.merged_data[y_col].astype(np.float64).where(in_window)
+        output = pd.DataFrame(windowed).groupby(self.merged_data['trial_key']).mean()
+        self.merged_data_first_row = self.merged_data_first_row.merge(output.reset_index(), on='trial_key')
+
+    def epoch_data(self, lock_event='stimulus_pre_with_fixation_onset', window=[-1000, 3000], \
+        y_col='smoothed_interp_pupil_corrected'):
+        '''
+        cut y_col into epochs locked at the first sample of lock_event (one of self.event_list) in each trial, from
+        window[0] to window[1] ms around it (both included). Returns
+        - a float32 (n_trials, n_timepoints) array, NaN where the trial has no sample at that time
+        - the time [ms] of each timepoint relative to the lock event
+        - a pd.DataFrame with the trial_key, block, trial and onset time of each trial (row of the array)
+        the samples are found by index arithmetic from the onset sample (data are sampled at self.sf), so that any
+        window statistic is a single reduction, e.g. np.nanmean(epochs[:, (times >= 500) & (times <= 2500)], axis=1)
+        '''
+        if lock_event not in self.event_list:
+            raise Exception('{} is not in event_list.'.format(lock_event))
+        if 'trial_key' in self.merged_data.columns:
+            trial_key = self.merged_data['trial_key'].to_numpy()
+        else:
+            trial_key = (self.merged_data['block'].astype('Int32') * self.trial_key_base + \
+                self.merged_data['trial'].astype('Int32')).fillna(-1).to_numpy(dtype=np.int32)
+        time = self.merged_data['time'].to_numpy(dtype=float)
+        y = self.merged_data[y_col].to_numpy(dtype=np.float32, na_value=np.nan)
+
+        # onset sample of lock_event in each trial
+        lock_rows = np.flatnonzero((self.merged_data['event'] == lock_event).to_numpy() & (trial_key >= 0))
+        keys, first = np.unique(trial_key[lock_rows], return_index=True)
+        onset_pos = lock_rows[first]
+
+        step = 1000 / self.sf
+        offsets = np.arange(np.ceil(window[0] / step), np.floor(window[1] / step) + 1).astype(np.int64)
+        times = offsets * step
+        expected = time[onset_pos][:, None] + times
+        pos = np.clip(onset_pos[:, None] + offsets, 0, len(time) - 1)
+        off_grid = np.abs(time[pos] - expected) > step / 2
+        if off_grid.any():
+            # samples are missing around some onsets (e.g. removed events), look those up by their time
+            pos[off_grid] = np.clip(np.searchsorted(time, expected[off_grid]), 0, len(time) - 1)
+        found = (np.abs(time[pos] - expected) <= step / 2) & (trial_key[pos] == keys[:, None])
+        epochs = np.where(found, y[pos], np.float32(np.nan))
+
+        trials = pd.DataFrame({'trial_key': keys, 'block': self.merged_data['block'].to_numpy()[onset_pos],
+                               'trial': self.merged_data['trial'].to_numpy()[onset_pos], 'onset': time[onset_pos]})
+        return epochs, times, trials
 
     def percent_miss(self, new_x_col='perc_miss'):
         '''
         calculate the percent of missing data in each trial based on whether pupil == 0
         '''    
-        def df_percent_miss(df):
-            return (df.pupil == 0).mean()
-        if not 'identifier' in self.merged_data.columns:
+        if not 'trial_key' in self.merged_data.columns:
             self.add_identifier()
-        output = self.merged_data.groupby('identifier').apply(df_percent_miss)
-        output = output.reset_index().rename(columns={0:new_x_col})
-        self.merged_data_first_row = self.merged_data_first_row.merge(output, on='identifier')
+        output = (self.merged_data['pupil'] == 0).groupby(self.merged_data['trial_key']).mean().rename(new_x_col)
+        self.merged_data_first_row = self.merged_data_first_row.merge(output.reset_index(), on='trial_key')
 
     def baseline_correct(self, baseline_col='trial_baseline', \
         pupil_col='smoothed_interp_pupil_corrected',\
@@ -1030,12 +1983,14 @@ class pypil(object):
         the current function is a simple one
         may add other functions in the future if needed
         '''
-        if (not 'identifier' in self.merged_data.columns) or (not 'identifier' in self.merged_data_first_row.columns):
+        if (not 'trial_key' in self.merged_data.columns) or (not 'trial_key' in self.merged_data_first_row.columns):
             self.add_identifier()
-        baseline_df = self.merged_data_first_row[['identifier',baseline_col]]
-        self.merged_data = self.merged_data.merge(baseline_df, how='left', on='identifier')
-        self.merged_data[new_x_col] = self.merged_data[pupil_col] - self.merged_data[baseline_col]
-        self.merged_data.drop(columns=baseline_col, inplace=True)
+        # look the baseline of each trial up through the trial codes instead of merging it into the long data
+        codes, keys = pd.factorize(self.merged_data['trial_key'])
+        baseline = self.merged_data_first_row.groupby('trial_key')[baseline_col].first().reindex(keys).to_numpy()
+        self.merged_data[new_x_col] = self.merged_data[pupil_col].to_numpy() - baseline[codes]
+        # the merge used to renumber the rows, keep doing so for the index column of the long csv
+        self.merged_data.index = pd.RangeIndex(len(self.merged_data))
 
     def write_merged_and_task(self, overwrite=False):
         '''
@@ -1043,17 +1998,18 @@ class pypil(object):
         the write of task df maybe a little redundant - majority changes are column names and trial calculation
         keep it for now in case it is needed in the future
         '''
-        if overwrite:
-            self.overwrite = overwrite
+        self.overwrite = bool(overwrite)
         
 
         if (not all([os.path.exists(os.path.join(self.data_dir, '{}_merged_pupil_first_row_AFTER.csv'.format(self.subjectid))),\
             os.path.exists(os.path.join(self.data_dir, '{}_merged_pupil_long_AFTER.csv'.format(self.subjectid))),\
                 os.path.exists(os.path.join(self.data_dir, '{}_task_AFTER.csv'.format(self.subjectid)))])) or self.overwrite:
 
-            self.merged_data.to_csv(os.path.join(self.data_dir, '{}_merged_pupil_long_AFTER.csv'.format(self.subjectid)))
-            self.merged_data_first_row.to_csv(os.path.join(self.data_dir, '{}_merged_pupil_first_row_AFTER.csv'.format(self.subjectid)))
-            self.task_df.to_csv(os.path.join(self.data_dir, '{}_task_AFTER.csv'.format(self.subjectid)))
+            # the long data only carries the integer trial_key, the identifier string is needed by the R scripts
+            self._add_identifier_labels(self.merged_data)
+            self._csv_ready(self.merged_data).to_csv(os.path.join(self.data_dir, '{}_merged_pupil_long_AFTER.csv'.format(self.subjectid)))
+            self._csv_ready(self.merged_data_first_row).to_csv(os.path.join(self.data_dir, '{}_merged_pupil_first_row_AFTER.csv'.format(self.subjectid)))
+            self._csv_ready(self.task_df).to_csv(os.path.join(self.data_dir, '{}_task_AFTER.csv'.format(self.subjectid)))
 
     def read_data_ready2use(self):
         '''
@@ -1073,15 +2029,14 @@ class pypil(object):
         '''
 
         # Haoxue: this function is NOT a part of the preprocess/filter/process valid sample routine. Is only called after the pupil data has finished processing
-        if overwrite:
-            self.overwrite = overwrite
+        self.overwrite = bool(overwrite)
 
         if (not os.path.exists(os.path.join(self.data_dir, '{}_merged_pupil_task.csv'.format(self.subjectid)))) or self.overwrite:
 
             task_df.rename(columns={'SubjectID': 'ID', 'Block': 'block', 'Trial': 'trial'}, inplace=True)
             task_df['trial'] = task_df['trial'] - 1
             self.merged_data_task = pd.merge(self.merged_data, task_df, how='left')
-            self.merged_data_task.to_csv(os.path.join(self.data_dir, '{}_merged_pupil_task.csv'.format(self.subjectid)), index=False)
+            self._csv_ready(self.merged_data_task).to_csv(os.path.join(self.data_dir, '{}_merged_pupil_task.csv'.format(self.subjectid)), index=False)
         
         else:
             self.merged_data_task = pd.read_csv(os.path.join(self.data_dir, '{}_merged_pupil_task.csv'.format(self.subjectid)))
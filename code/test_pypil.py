@@ -0,0 +1,411 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import pypil
+
+
+def test_written_identifiers_match_notebook(tmp_path):
+    # block 1 trial 10 and block 11 trial 0 must not share an identifier
+    blocks, trials = [1, 1, 11, 11], [0, 10, 0, 1]
+    p = pypil.pypil(str(tmp_path / 'S01_task.asc'))
+    p.merged_data = pd.DataFrame({'time': np.arange(12), 'ID': 'S01', 'block': np.repeat(blocks, 3).astype(float),
+                                  'trial': np.repeat(trials, 3).astype(float), 'pupil': 1000.})
+    p.task_df = pd.DataFrame({'ID': 'S01', 'block': np.array(blocks, dtype=float), 'trial': np.array(trials, dtype=float),
+                              'cond': np.arange(4)})
+    p.add_identifier()
+    p.add_first_row_pupil()
+    p.write_merged_and_task()
+
+    for name in ['merged_pupil_long_AFTER', 'merged_pupil_first_row_AFTER', 'task_AFTER']:
+        df = pd.read_csv(os.path.join(str(tmp_path), 'S01_{}.csv'.format(name)))
+        # as rebuilt in Preprocess_cleanup_github.ipynb
+        identifier = df['ID'] + df['block'].astype(str) + df['trial'].astype(str)
+        assert (identifier == df['identifier']).all(), name
+        assert df['identifier'].nunique() == df['trial_key'].nunique() == 4, name
+
+
+def _recording(rate=1000):
+    '''
+    a short monocular (right eye) EyeLink recording with a baseline and 16 one-trial blocks, as
+    (samples [time, x, y, pupil; NaN if missing], events [start, end, type], messages [time, text])
+    '''
+    rng = np.random.default_rng(0)
+    samples, events, messages = [], [], []
+    t = [10000]
+
+    def record(n, blink=None):
+        for i in range(n):
+            if blink is not None and blink[0] <= i < blink[1]:
+                samples.append([t[0], np.nan, np.nan, np.nan])
+            else:
+                samples.append([t[0], 960 + rng.normal(0, 20), 540 + rng.normal(0, 20), 1300 + rng.normal(0, 5)])
+            t[0] += 1000 // rate
+        if blink is not None:
+            start = samples[blink[0] - n][0]
+            events.append((start, start + blink[1] - blink[0] - 1, 'blink'))
+
+    def message(text):
+        messages.append((t[0], text))
+
+    message('RECCFG CR {} 2 1 R'.format(rate))
+    record(100)
+    message('baseline_onset')
+    record(1000, blink=(300, 400))
+    message('baseline_end')
+    record(100)
+    for block in range(1, 17):
+        message('BLOCKID {} block_start'.format(block))
+        record(50)
+        for event in ['fixation_onset', 'stimulus_pre_with_fixation_onset', 'key_press', 'reward_pre_red_fixation_onset']:
+            message('BLOCKID {} TRIALID 1 {}'.format(block, event))
+            record(100, blink=(40, 60) if event == 'key_press' else None)
+        message('TRIAL_RESULT 0')
+        record(50)
+    record(100)
+    events.append((samples[5000][0], samples[5200][0], 'fixation'))
+    # EyeLink keeps a tenth of a pixel (and of the pupil unit), as the ASC file does
+    return np.round(samples, 1), events, messages
+
+
+def _write_asc(file_name, samples, events, messages):
+    lines = [(samples[0, 0], 0, 'START\t{:d} \tRIGHT\tSAMPLES\tEVENTS\n'.format(int(samples[0, 0]))),
+             (samples[0, 0], 0, 'SAMPLES\tGAZE\tRIGHT\tRATE\t1000.00\tTRACKING\tCR\tFILTER\t2\n')]
+    for time, x, y, pupil in samples:
+        if np.isnan(pupil):
+            line = '{:d}\t   .\t   .\t    0.0\t...\n'.format(int(time))
+        else:
+            line = '{:d}\t{:7.1f}\t{:7.1f}\t{:7.1f}\t...\n'.format(int(time), x, y, pupil)
+        lines.append((time, 2, line))
+    names = {'fixation': 'FIX', 'blink': 'BLINK'}
+    for start, end, kind in events:
+        lines.append((start, 1, 'S{} R {:d}\n'.format(names[kind], int(start))))
+        lines.append((end, 3, 'E{} R {:d}\t{:d}\t{:d}\n'.format(names[kind], int(start), int(end), int(end - start + 1))))
+    lines += [(time, 1, 'MSG\t{:d} {}\n'.format(int(time), text)) for time, text in messages]
+    lines.append((samples[-1, 0], 4, 'END\t{:d} \tSAMPLES\tEVENTS\tRES\t  38.00\t  35.00\n'.format(int(samples[-1, 0]))))
+    with open(file_name, 'w') as f:
+        f.writelines(x[2] for x in sorted(lines, key=lambda x: x[:2]))
+
+
+def _install_pyedfread(monkeypatch, samples, events, messages):
+    # pyedfread needs the SR Research EDF API, the test double returns the tables it would read from the EDF file
+    def read_edf(filename):
+        missing = np.isnan(samples[:, 3])
+        gaze = np.where(missing[:, None], 1e8, samples[:, 1:3])
+        edf_samples = pd.DataFrame({'time': samples[:, 0], 'gx_left': 1e8, 'gx_right': gaze[:, 0], 'gy_left': 1e8,
+                                    'gy_right': gaze[:, 1], 'pa_left': 0., 'pa_right': np.where(missing, 0., samples[:, 3])})
+        edf_events = pd.DataFrame([(start, end, kind, 1) for start, end, kind in events], columns=['start', 'end', 'type', 'eye'])
+        return edf_samples, edf_events, pd.DataFrame(messages, columns=['time', 'message'])
+    pyedfread = type(sys)('pyedfread')
+    pyedfread.read_edf = read_edf
+    monkeypatch.setitem(sys.modules, 'pyedfread', pyedfread)
+
+
+def test_read_edf_stub_schema_matches_asc(tmp_path, monkeypatch):
+    samples, events, messages = _recording()
+    (tmp_path / 'asc').mkdir()
+    (tmp_path / 'edf').mkdir()
+    _write_asc(str(tmp_path / 'asc' / 'S01_task.asc'), samples, events, messages)
+    (tmp_path / 'edf' / 'S01_task.edf').touch()
+    _install_pyedfread(monkeypatch, samples, events, messages)
+
+    asc = pypil.pypil(pypil.find_recording(str(tmp_path / 'asc')))
+    edf = pypil.pypil(pypil.find_recording(str(tmp_path / 'edf')))
+    for p in [asc, edf]:
+        p.write_raw_csv = False
+        p.prepare_phase(True)
+    assert (asc.eyelinkrate, asc.contain_baseline) == (edf.eyelinkrate, edf.contain_baseline) == (1000, 1)
+    # the event lines (blinks, fixations) only differ in their white space
+    for table in ['small_badstring_file', 'baseline_badstring_file']:
+        assert [x.split() for x in getattr(asc, table)] == [x.split() for x in getattr(edf, table)]
+    for table in ['message_data', 'pupil_data', 'baseline_pupil_data', 'merged_data']:
+        pd.testing.assert_frame_equal(getattr(asc, table).reset_index(drop=True), getattr(edf, table).reset_index(drop=True))
+    assert (edf.message_data['event'] == 'key_press').sum() == 16 and (edf.merged_data['pupil'] == 0).any()
+
+
+def test_read_edf_missing_columns(tmp_path, monkeypatch):
+    samples, events, messages = _recording()
+    (tmp_path / 'S01_task.edf').touch()
+    # an older pyedfread names the message text column differently
+    _install_pyedfread(monkeypatch, samples, events, messages)
+    read_edf = sys.modules['pyedfread'].read_edf
+    monkeypatch.setattr(sys.modules['pyedfread'], 'read_edf',
+                        lambda filename: read_edf(filename)[:2] + (read_edf(filename)[2].rename(columns={'message': 'text'}),))
+    with pytest.raises(ValueError, match='messages message'):
+        pypil.pypil(str(tmp_path / 'S01_task.edf')).read_contents()
+
+
+def test_baseline_sections(tmp_path, monkeypatch):
+    samples, events, messages = _recording()
+    # the baseline (10100 to 11100) is split into two sections, the samples between them are not baseline
+    messages += [(10600, 'baseline_end'), (10800, 'baseline_onset')]
+    messages.sort(key=lambda x: x[0])
+    _write_asc(str(tmp_path / 'S01_task.asc'), samples, events, messages)
+    (tmp_path / 'S01_task.edf').touch()
+    _install_pyedfread(monkeypatch, samples, events, messages)
+    # a marker line comes before the sample of the same time: a section runs from its start marker up to its end marker
+    expected = samples[_ranges(samples[:, 0], [(10100, 10599), (10800, 11099)]), 0]
+
+    asc = pypil.pypil(str(tmp_path / 'S01_task.asc'))
+    asc.read_contents()
+    blocks = pypil.pypil(str(tmp_path / 'S01_task.asc'))
+    list(blocks._read_task_blocks())
+    edf = pypil.pypil(str(tmp_path / 'S01_task.edf'))
+    edf.read_contents()
+    for p in [asc, blocks, edf]:
+        assert p.contain_baseline == 1
+        np.testing.assert_array_equal(p.asc_lines['baseline']['samples'].to_frame()['time'], expected)
+        # the blink of the first section
+        assert [x.split()[0] for x in p.asc_lines['baseline']['badstrings']] == ['SBLINK', 'EBLINK']
+
+
+def _ranges(time, ranges):
+    return np.any([(time >= start) & (time <= stop) for start, stop in ranges], axis=0)
+
+
+def test_remove_loners():
+    p = pypil.pypil('S01_task.asc')
+    p.default_filter_settings()
+    time = np.arange(0, 700, 4)
+    # a 40 ms gap does not separate (200-240), a 44 ms gap does; islands narrower than 50 ms are removed
+    valid = _ranges(time, [(0, 200), (240, 260), (304, 336), (380, 440), (484, 532), (576, 628)])
+    is_valid = np.array([valid, np.ones_like(valid)])
+    out = pypil._remove_loners(time, is_valid, is_valid, p.filter_settings)
+    assert np.array_equal(out[0], _ranges(time, [(0, 260), (380, 440), (576, 628)]) & valid)
+    # eyes are separate: the samples of the other eye do not bridge the gaps
+    assert out[1].all()
+    # only samples of both candidate and is_valid are kept
+    out = pypil._remove_loners(time, is_valid, is_valid & (time != 0), p.filter_settings)
+    assert np.array_equal(out[0], _ranges(time, [(4, 260), (380, 440), (576, 628)]) & valid)
+
+
+def test_gaps_ms():
+    p = pypil.pypil('S01_task.asc')
+    p.default_interp_settings(upsample=1000)
+    p.merged_data = pd.DataFrame({'time': [100, 104, 108, 150, 200, 204], 'is_valid': [1, 1, 1, 0, 1, 1]}).astype({'is_valid': bool})
+    # before the first valid sample: distance to it; between valid samples: width of the gap the time falls in;
+    # after the last one: distance to it; 0 within half an upsampling interval (0.5 ms) of a valid sample
+    times = [90, 100, 102, 107.6, 108.4, 108.5, 150, 199.5, 199.4, 204.4, 210]
+    assert np.array_equal(p._gaps_ms(times), [10, 0, 4, 0, 0, 92, 92, 0, 92, 0, 6])
+
+    # on a coarser grid (100 Hz, half an interval of 5 ms is more than the 4 ms between valid samples), touching is
+    # [valid - 5 ms, valid + 5 ms)
+    p.interp_settings['interp_upsampling_freq'] = 100
+    times = [94, 95, 102, 112.9, 113, 150, 194.9, 195, 208.9, 209, 215]
+    assert np.array_equal(p._gaps_ms(times), [6, 0, 0, 0, 92, 92, 92, 0, 0, 5, 11])
+
+
+def test_sample_sink_ragged_lines():
+    sink = pypil._SampleSink(chunk_size=4)
+    # 4 lines with 20 fields in total, but the second one misses its dots column and the third one has an extra field
+    for line in ['100\t1.0\t2.0\t3.0\t...\n', '101\t1.1\t2.1\t3.1\n', '102\t.\t.\t0.0\t...\t9\n', '103\t1.3\t2.3\t3.3\tC..\n']:
+        sink.append(line)
+    assert sink.n == 4
+    np.testing.assert_array_equal(sink.values[:4], [[100, 1, 2, 3], [101, 1.1, 2.1, 3.1], [102, np.nan, np.nan, 0],
+                                                   [103, 1.3, 2.3, 3.3]])
+    assert list(sink.dots[:4]) == ['...', '.', '...', 'C..']
+
+
+def test_filter_samples():
+    p = pypil.pypil('S01_task.asc')
+    p.default_filter_settings()
+    time = np.arange(0, 2000, 4)
+    clean = 1000 + 20 * np.sin(time / 300) + np.random.default_rng(0).normal(0, 0.1, len(time))
+    pupil = clean.copy()
+    pupil[time == 400] += 50
+    # a blink, and a 24 ms island (1200-1224) between two short gaps
+    pupil[_ranges(time, [(800, 996), (1160, 1196), (1228, 1268)])] = 0
+    valid, speed_data, passes = pypil.filter_samples(time, pupil, np.ones(len(time), dtype=bool), p.filter_settings)
+
+    # step 1: out of bounds, and the island
+    np.testing.assert_array_equal(speed_data['max_dilation_speeds'][0], np.flatnonzero(~_ranges(time, [(800, 996), (1160, 1268)])))
+    # step 2: the first sample and the one after the 208 ms gap (no speed, the gap is wider than 200 ms), the spike
+    # and its neighbours (speed changes of about 12.5 to 25), and the samples on either side of the 75-2000 ms gaps
+    expected = ~_ranges(time, [(0, 0), (396, 408), (796, 1004), (1156, 1272)])
+    np.testing.assert_array_equal(speed_data['is_valid'], expected)
+    # step 3: the residuals of the noise are all within 16 MAD
+    np.testing.assert_array_equal(valid, expected)
+    assert len(passes) == p.filter_settings['residuals_filter_passes']
+
+    # a binocular recording: every eye has its own thresholds, a clean eye only loses its first sample
+    valid, speed_data, passes = pypil.filter_samples(time, np.c_[pupil, clean], np.ones((len(time), 2), dtype=bool), p.filter_settings)
+    np.testing.assert_array_equal(valid, np.c_[expected, time != 0])
+    assert speed_data['is_valid'].shape == passes[0][0].shape == (len(time), 2)
+
+
+def test_incremental_deviation_passes(monkeypatch):
+    p = pypil.pypil('S01_task.asc')
+    p.default_filter_settings()
+    time = np.arange(0, 20000, 4)
+    pupil = 1000 + 20 * np.sin(time / 300) + np.random.default_rng(0).normal(0, 0.1, len(time))
+    # slow 60 ms drifts away from the trendline: the speed filter keeps them, the deviation passes reject them
+    for start in [2000, 7000, 12000, 15000]:
+        drift = _ranges(time, [(start, start + 60)])
+        pupil[drift] += np.linspace(1, 3, drift.sum())
+    is_valid = np.ones(len(time), dtype=bool)
+
+    filtfilt = pypil.signal.filtfilt
+    lengths = []
+    monkeypatch.setattr(pypil.signal, 'filtfilt', lambda b, a, x: (lengths.append(x.shape[-1]), filtfilt(b, a, x))[1])
+    valid, _, passes = pypil.filter_samples(time, pupil, is_valid, p.filter_settings)
+    # the later passes only re-smooth the windows around the changed samples
+    assert min(lengths) < len(time) // 2
+
+    # a single window over all samples makes every pass recompute the whole trendline
+    monkeypatch.setattr(pypil, '_changed_windows', lambda changed, anchors, margin, n_samples: (np.array([0]), np.array([n_samples])))
+    lengths.clear()
+    full_valid, _, full_passes = pypil.filter_samples(time, pupil, is_valid, p.filter_settings)
+    assert lengths == [len(time)] * len(lengths)
+
+    np.testing.assert_array_equal(valid, full_valid)
+    # the later passes reject more of the drifts
+    assert (passes[0][2] != passes[-1][2]).any()
+    for (resid, smooth, pass_valid), (full_resid, full_smooth, full_pass_valid) in zip(passes, full_passes):
+        np.testing.assert_allclose(smooth, full_smooth, rtol=1e-6)
+        np.testing.assert_allclose(resid, full_resid, atol=1e-3)
+        np.testing.assert_array_equal(pass_valid, full_pass_valid)
+
+
+def test_smoothing_modes():
+    time = np.arange(0, 20000, 4)
+    pupil = 1000 + 20 * np.sin(time / 300) + np.random.default_rng(0).normal(0, 0.5, len(time))
+    # a 1 s gap (longer than segment_min_gap), and a new block at 14 s
+    is_valid = ~_ranges(time, [(8000, 9000)])
+    smoothed = {}
+    for mode in ['session', 'segments']:
+        p = pypil.pypil('S01_task.asc')
+        p.default_interp_settings()
+        p.interp_settings['smoothing_mode'] = mode
+        p.merged_data = pd.DataFrame({'time': time, 'is_valid': is_valid, 'inter_pupil': np.where(is_valid, pupil, np.nan),
+                                      'block': np.where(time < 14000, 1., 2.)})
+        p._interp_and_smooth()
+        smoothed[mode] = p.merged_data['smoothed_interp_pupil'].to_numpy()
+        np.testing.assert_array_equal(np.isnan(smoothed[mode]), ~is_valid)
+
+    # the modes only differ where the filter has not settled since a segment edge
+    away = ~_ranges(time, [(6000, 11000), (12000, 16000)])
+    np.testing.assert_allclose(smoothed['segments'][away], smoothed['session'][away], atol=1e-3)
+    # which is also where the block changes
+    assert abs(smoothed['segments'][3500] - smoothed['session'][3500]) > .1
+
+
+def test_upsampled_output():
+    p = pypil.pypil('S01_task.asc')
+    p.default_interp_settings(upsample=100)
+    p.interp_settings['upsampled_output'] = True
+    time = np.arange(3, 5000, 4)
+    pupil = 1000 + 20 * np.sin(time / 300)
+    # a 400 ms gap, longer than interp_max_gap
+    is_valid = ~_ranges(time, [(2000, 2400)])
+    p.merged_data = pd.DataFrame({'time': time, 'is_valid': is_valid, 'inter_pupil': np.where(is_valid, pupil, np.nan)})
+    p._interp_and_smooth()
+
+    # every 10 ms from the first sample, up to within half a step of the last one
+    grid = p.upsampled_data['time'].to_numpy()
+    np.testing.assert_array_equal(grid, np.arange(3, 5004, 10))
+    # missing in the gap between the valid samples 1999 and 2403, but not within half a step (5 ms) of them
+    np.testing.assert_array_equal(np.isnan(p.upsampled_data['smoothed_interp_pupil']), (grid >= 2004) & (grid < 2398))
+    # the samples get the pupil interpolated from the grid, missing in the gap except for 2003 (on the grid, and
+    # within half a step of 1999)
+    smoothed = p.merged_data['smoothed_interp_pupil'].to_numpy()
+    np.testing.assert_array_equal(np.isnan(smoothed), ~is_valid & (time != 2003))
+    np.testing.assert_allclose(smoothed[is_valid], np.interp(time, grid, p.upsampled_data['smoothed_interp_pupil'])[is_valid], rtol=1e-6)
+    np.testing.assert_allclose(smoothed[is_valid], pupil[is_valid], atol=1)
+
+
+def _trial_data(tmp_path):
+    '''
+    a pypil object with two trials of block 1 (the second one without stimulus onset) and two samples outside of
+    the trials, every 4 ms
+    '''
+    p = pypil.pypil(str(tmp_path / 'S01_task.asc'))
+    events = ['fixation_onset'] * 3 + ['stimulus_pre_with_fixation_onset'] * 3 + ['fixation_onset'] * 2 + \
+        ['key_press'] * 4 + ['blank_screen'] * 2
+    p.merged_data = pd.DataFrame({'time': np.arange(0, 56, 4), 'ID': 'S01', 'block': [1.] * 12 + [np.nan] * 2,
+                                  'trial': [0.] * 6 + [1.] * 6 + [np.nan] * 2, 'event': events,
+                                  'pupil': [1000., 0, 1002, 1003, 1004, 1005, 0, 0, 0, 1009, 1010, 1011, 1012, 0]})
+    p.task_df = pd.DataFrame({'ID': 'S01', 'block': [1., 1.], 'trial': [0., 1.]})
+    return p
+
+
+def test_add_timestamp(tmp_path):
+    p = _trial_data(tmp_path)
+    p.add_timestamp()
+    time = p.merged_data['time'].to_numpy(dtype=float)
+    trial = np.repeat([0, 1, -1], [6, 6, 2])
+    # the onset of each event in each trial (NaN without that event); columns in the order of the trial keys
+    onsets = {'blank_screen': [np.nan, np.nan, 48], 'fixation_onset': [0, 24, np.nan],
+              'stimulus_pre_with_fixation_onset': [12, np.nan, np.nan], 'key_press': [np.nan, 32, np.nan]}
+    assert [x for x in p.merged_data.columns if x.startswith('timestamp_locked_at_')] == \
+        ['timestamp_locked_at_' + x for x in onsets]
+    for event, onset in onsets.items():
+        np.testing.assert_array_equal(p.merged_data['timestamp_locked_at_' + event], time - np.array(onset)[trial], event)
+
+
+def test_percent_miss_and_baseline_correct(tmp_path):
+    p = _trial_data(tmp_path)
+    p.merged_data.index = np.arange(0, 28, 2)
+    p.add_identifier()
+    p.merged_data_first_row = pd.DataFrame({'trial_key': [1000, 1001], 'trial_baseline': [900., 950.]})
+
+    # the share of samples with pupil 0 in each trial
+    p.percent_miss()
+    np.testing.assert_allclose(p.merged_data_first_row['perc_miss'], [1 / 6, 3 / 6])
+
+    # samples outside of the trials have no baseline
+    p.baseline_correct(pupil_col='pupil', new_x_col='corrected')
+    np.testing.assert_array_equal(p.merged_data['corrected'], p.merged_data['pupil'] - np.repeat([900, 950, np.nan], [6, 6, 2]))
+    assert p.merged_data.index.equals(pd.RangeIndex(14))
+
+
+def test_epoch_data_matches_window_mean(tmp_path):
+    rng = np.random.default_rng(0)
+    trials = []
+    for trial in range(6):
+        events = ['fixation_onset'] * 30 + ['stimulus_pre_with_fixation_onset'] * rng.integers(30, 60)
+        trials.append(pd.DataFrame({'block': 1., 'trial': float(trial),
+                                    'event': events if trial != 5 else ['fixation_onset'] * len(events)}))
+    data = pd.concat(trials, ignore_index=True)
+    data['time'] = np.arange(len(data)) * 4
+    data['y'] = np.where(rng.random(len(data)) < .2, np.nan, rng.normal(1000, 10, len(data)))
+    # samples removed from the middle of a trial
+    data = data.drop(index=np.flatnonzero((data['trial'] == 3) & (data['event'] != 'fixation_onset'))[5:15])
+    p = pypil.pypil(str(tmp_path / 'S01_task.asc'))
+    p.merged_data = data.assign(ID='S01').reset_index(drop=True)
+    p.task_df = pd.DataFrame({'ID': 'S01', 'block': 1., 'trial': np.arange(6.)})
+    p.add_identifier()
+
+    epochs, times, epoch_trials = p.epoch_data(window=[-100, 200], y_col='y')
+    assert epochs.shape == (5, 76) and times[0] == -100 and times[-1] == 200
+    np.testing.assert_array_equal(epoch_trials['trial'], np.arange(5.))
+
+    # the same window averaged over the event-locked timestamps (NaN for the trial without the lock event)
+    p.add_timestamp()
+    p.merged_data_first_row = pd.DataFrame({'trial_key': np.arange(1000, 1006)})
+    p.avg_within_timewindows([('stimulus_pre_with_fixation_onset', [-100, 200], 'y', 'avg')])
+    np.testing.assert_allclose(np.nanmean(epochs, axis=1), p.merged_data_first_row['avg'][:5], rtol=1e-6)
+    assert np.isnan(p.merged_data_first_row['avg'][5])
+
+
+def test_resample_poly_missing():
+    p = pypil.pypil('S01_task.asc')
+    p.eyelinkrate, p.sf = 1000, 250
+    time = np.arange(10000, 12000)
+    pupil = 1300 + 10 * np.sin(time / 100)
+    x = np.full(len(time), 960.)
+    # 20 ms at the start, a single sample, a 40 ms blink and 3 ms
+    for start, stop in [(0, 20), (500, 501), (1000, 1040), (1500, 1503)]:
+        pupil[start:stop] = 0
+    x[1000:1040] = np.nan
+    resampled = p._resample_poly(pd.DataFrame({'time': time, 'x': x, 'y': 540., 'pupil': pupil, 'event': 'fixation_onset'}))
+
+    new_time = resampled['time'].to_numpy()
+    np.testing.assert_array_equal(new_time, np.arange(10000, 12000, 4))
+    # a missing stretch keeps the new samples within it, shorter ones than half the new interval are filled in
+    missing = _ranges(new_time, [(10000, 10019), (11000, 11039), (11500, 11502)])
+    np.testing.assert_array_equal(resampled['pupil'] == 0, missing)
+    np.testing.assert_array_equal(resampled['x'].isna(), _ranges(new_time, [(11000, 11039)]))
+    np.testing.assert_allclose(resampled['pupil'][~missing], 1300 + 10 * np.sin(new_time[~missing] / 100), atol=.1)